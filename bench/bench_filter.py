@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+
+# Micro-benchmark of file filtering: the old per-file regex building against the
+# precompiled filefilter, over a synthetic listing of 1M filenames.
+#
+#   python3 bench/bench_filter.py [count]
+
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sstransfer import filefilter
+
+EXTINC = 'csv:txt,txt,xml,json,dat'
+EXTEXC = 'tmp,part,bak'
+
+# ---------------------------------------------------------------------------------------------------------
+# The filtering as it was done before filefilter, a new regex for each file and extension
+def oldExclude(sfile,extFilterExc):
+    for ext in extFilterExc.split(','):
+        if re.search('\.{e}$'.format(e=ext), sfile, re.I):
+            return False
+    return True
+
+def oldInclude(sfile,extFilterInc):
+    for ext in extFilterInc.split(','):
+        extc = ext.split(':')
+        if re.search('\.{e}$'.format(e=extc[0]), sfile, re.I):
+            if len(extc) > 1:
+                sfile='{f}.{e}'.format(f=os.path.splitext(sfile)[0],e=extc[1])
+            return (True,sfile)
+    return (False,sfile)
+
+# ---------------------------------------------------------------------------------------------------------
+# Synthetic listing
+def names(count):
+    rnd = random.Random(1)
+    exts = ['csv','txt','xml','json','dat','tmp','part','bak','log','pdf','CSV','tar.gz']
+    return ['file_{i:07d}.{e}'.format(i=i,e=rnd.choice(exts)) for i in range(count)]
+
+# ---------------------------------------------------------------------------------------------------------
+def run(title,func,listing):
+    t = time.perf_counter()
+    n = 0
+    for sfile in listing:
+        if func(sfile):
+            n += 1
+    t = time.perf_counter() - t
+    print('{t:<12} {n:>9} included  {s:8.3f} s  {r:12.0f} names/s'.format(t=title,n=n,s=t,r=len(listing)/t))
+    return n
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    listing = names(count)
+
+    def old(sfile):
+        return oldExclude(sfile,EXTEXC) and oldInclude(sfile,EXTINC)[0]
+
+    f = filefilter(EXTINC,EXTEXC)
+    def new(sfile):
+        return f.checkExclude(sfile) and f.checkInclude(sfile)[0]
+
+    print('Filtering {c} names'.format(c=count))
+    a = run('old',old,listing)
+    b = run('filefilter',new,listing)
+    if a != b:
+        print('Mismatch between old and filefilter results!')
+        sys.exit(1)
@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+
+# Benchmark of transfer.doType1/doType2 against a local sftp server (bench/sftpserver.py)
+# with optional injected latency and bandwidth limit. Log lines go to a file in the
+# temporary directory, database logging goes through dbwriter to a stub connection
+# which only counts the statements (--nodb to leave it out).
+#
+# Reports files/s, MB/s, sftp round trips per file and peak RSS for each dataset.
+# Results are appended as json lines to bench/results.jsonl (--results, not tracked
+# by git) so runs can be compared over time.
+#
+#   python3 bench/bench_transfer.py [--dataset tiny,huge,mixed] [--latency ms] [--bandwidth KB/s] [--workers N] [--conntype asyncsftp]
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import resource
+import subprocess
+from datetime import datetime
+
+benchpath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(benchpath,'..'))
+sys.path.insert(0,benchpath)
+from sstransfer import logoutput,transfer,dbwriter
+import sftpserver
+
+# Datasets: list of (count,size in bytes)
+DATASETS = {
+    'tiny': [(2000,1024)],
+    'huge': [(3,64*1048576)],
+    'mixed': [(500,4096),(50,1048576),(2,32*1048576)],
+}
+
+# ---------------------------------------------------------------------------------------------------------
+# Create files of a dataset in "path"
+def makeDataset(path,spec):
+    rnd = random.Random(1)
+    block = bytes(rnd.getrandbits(8) for i in range(65536))
+    n = 0
+    total = 0
+    for (count,size) in spec:
+        for i in range(count):
+            with open(os.path.join(path,'file_{n:06d}.dat'.format(n=n)),'wb') as f:
+                left = size
+                while left > 0:
+                    f.write(block[:min(left,len(block))])
+                    left -= min(left,len(block))
+            n += 1
+            total += size
+    return (n,total)
+
+##############################################################################
+## stubconn class
+## Stands in for a mysql.connector connection: statements are counted, not run
+##############################################################################
+class stubconn:
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+        self.lastrowid = 0
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Cursor of the connection
+    def cursor(self):
+        return stubcursor(self)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Nothing to commit
+    def commit(self):
+        pass
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Nothing to roll back
+    def rollback(self):
+        pass
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Close (nothing to close)
+    def close(self):
+        pass
+
+##############################################################################
+## stubcursor class
+##############################################################################
+class stubcursor:
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class
+    def __init__(self,conn):
+        self.conn = conn
+        self.lastrowid = 0
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Count a statement writing one row
+    def execute(self,sql,params=()):
+        self.conn.statements += 1
+        self.conn.rows += 1
+        self.conn.lastrowid += 1
+        self.lastrowid = self.conn.lastrowid
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Count a statement writing a row for each of "params"
+    def executemany(self,sql,params):
+        self.conn.statements += 1
+        self.conn.rows += len(params)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Result of the customer id lookup
+    def fetchall(self):
+        return [(1,)]
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Close (nothing to close)
+    def close(self):
+        pass
+
+# ---------------------------------------------------------------------------------------------------------
+# Current git commit of the tree, '' if not known
+def gitCommit():
+    try:
+        return subprocess.check_output(['git','rev-parse','--short','HEAD'],cwd=benchpath,stderr=subprocess.DEVNULL).decode().strip()
+    except Exception as e:
+        return ''
+
+# ---------------------------------------------------------------------------------------------------------
+# Run one dataset with doType1 (files are moved) or doType2 (sqlite timestamps)
+def runDataset(name,settype,args):
+    work = tempfile.mkdtemp(prefix='ctransfer-bench-')
+    try:
+        local = os.path.join(work,'from')
+        remote = os.path.join(work,'remote')
+        os.makedirs(local)
+        os.makedirs(remote)
+        (count,total) = makeDataset(local,DATASETS[name])
+
+        srv = sftpserver.server(remote,args.latency / 1000.0,args.bandwidth * 1024)
+        cwd = os.getcwd()
+        os.chdir(work)      # type 2 database is created in current directory
+        try:
+            sid = 'BENCH-{d}-{t}'.format(d=name,t=settype)
+            log = logoutput(sid,os.path.join(work,'bench.log'))
+            db = stubconn()
+            if not args.nodb:
+                log.dbwriter = dbwriter(sid,{},db,os.path.join(work,'bench.log.spill'),log.logger)
+                log.dbwriter.metrics = log.metrics
+            tr = transfer(sid,log,work)
+            tr.setRemote(host='127.0.0.1',port=srv.port,user='bench',password='bench',conntype=args.conntype)
+            tr.setWorkers(args.workers)
+            tr.connect()
+            srv.stats.reset()
+
+            t = time.perf_counter()
+            if settype == '1':
+                tr.doType1(local,'/upload',os.path.join(work,'transfered'))
+            else:
+                tr.doType2('set-bench',local,'/upload')
+            t = time.perf_counter() - t
+
+            # Remaining database events are written on close
+            tc = time.perf_counter()
+            tr.close()
+            log.close()
+            tc = time.perf_counter() - tc
+        finally:
+            os.chdir(cwd)
+            srv.close()
+
+        return {
+            'ts': datetime.now().isoformat(timespec='seconds'),
+            'commit': gitCommit(),
+            'dataset': name,
+            'type': settype,
+            'files': count,
+            'bytes': total,
+            'latency_ms': args.latency,
+            'bandwidth_kbs': args.bandwidth,
+            'workers': args.workers,
+            'conntype': args.conntype,
+            'seconds': round(t,3),
+            'close_seconds': round(tc,3),
+            'db_statements': db.statements,
+            'db_rows': db.rows,
+            'files_per_sec': round(count / t,1),
+            'mb_per_sec': round(total / 1048576 / t,2),
+            'roundtrips_per_file': round(srv.stats.roundTrips / max(1,count),2),
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+    finally:
+        shutil.rmtree(work,ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark transfer against a local sftp server')
+    parser.add_argument('--dataset',default='tiny,huge,mixed',help='comma separated: ' + ','.join(DATASETS))
+    parser.add_argument('--type',default='1,2',help='set types to run')
+    parser.add_argument('--latency',type=float,default=0,help='added latency per sftp request in ms')
+    parser.add_argument('--bandwidth',type=int,default=0,help='write bandwidth limit in KB/s (0 = none)')
+    parser.add_argument('--workers',type=int,default=1,help='parallel uploads')
+    parser.add_argument('--conntype',default='sftp',help='sftp or asyncsftp')
+    parser.add_argument('--nodb',action='store_true',help='no database logging')
+    parser.add_argument('--results',default=os.path.join(benchpath,'results.jsonl'),help='json lines file results are appended to ("" = none)')
+    args = parser.parse_args()
+
+    print('{d:<8} {t:>4} {f:>7} {s:>9} {fs:>10} {mb:>9} {rt:>8} {rss:>10} {db:>8}'.format(
+        d='dataset',t='type',f='files',s='seconds',fs='files/s',mb='MB/s',rt='rt/file',rss='rss KB',db='db rows'))
+    for name in args.dataset.split(','):
+        for settype in args.type.split(','):
+            r = runDataset(name,settype,args)
+            print('{d:<8} {t:>4} {f:>7} {s:>9.2f} {fs:>10.1f} {mb:>9.2f} {rt:>8.2f} {rss:>10} {db:>8}'.format(
+                d=name,t=settype,f=r['files'],s=r['seconds'],fs=r['files_per_sec'],mb=r['mb_per_sec'],
+                rt=r['roundtrips_per_file'],rss=r['peak_rss_kb'],db=r['db_rows']))
+            if args.results != '':
+                with open(args.results,'a') as f:
+                    f.write(json.dumps(r) + '\n')
@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+
+# Local in-process sftp server for benchmarks, serving a directory.
+# Every sftp request is counted as a round trip and can be delayed by
+# "latency" seconds. Writes can be limited to "bandwidth" bytes/second.
+# The delay is added in the server thread, so pipelined requests are delayed
+# one after another; good enough for comparing runs, not a network model.
+
+import os
+import socket
+import threading
+import time
+import paramiko
+from paramiko import SFTPServer,SFTPServerInterface,SFTPAttributes,SFTPHandle,SFTP_OK
+
+##############################################################################
+## stats class, shared by all sessions of a server
+##############################################################################
+class stats:
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class
+    def __init__(self,root='',latency=0.0,bandwidth=0):
+        self.root = root
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.reset()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Reset counters
+    def reset(self):
+        with self.lock:
+            self.roundTrips = 0
+            self.bytesWritten = 0
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Count a request and wait for the injected latency
+    def request(self):
+        with self.lock:
+            self.roundTrips += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Count written bytes and wait for the bandwidth limit
+    def written(self,n):
+        with self.lock:
+            self.bytesWritten += n
+        if self.bandwidth > 0:
+            time.sleep(n / self.bandwidth)
+
+##############################################################################
+## Open file of a session
+##############################################################################
+class benchhandle(SFTPHandle):
+
+    def stat(self):
+        self.benchstats.request()
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self,attr):
+        self.benchstats.request()
+        try:
+            SFTPServer.set_file_attr(self.filename,attr)
+            return SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def read(self,offset,length):
+        self.benchstats.request()
+        return SFTPHandle.read(self,offset,length)
+
+    def write(self,offset,data):
+        self.benchstats.request()
+        self.benchstats.written(len(data))
+        return SFTPHandle.write(self,offset,data)
+
+##############################################################################
+## sftp session serving stats.root
+##############################################################################
+class benchsftp(SFTPServerInterface):
+
+    def __init__(self,server,benchstats,*args,**kwargs):
+        super().__init__(server,*args,**kwargs)
+        self.benchstats = benchstats
+
+    def _realpath(self,path):
+        return self.benchstats.root + SFTPServerInterface.canonicalize(self,path)
+
+    def canonicalize(self,path):
+        self.benchstats.request()
+        return SFTPServerInterface.canonicalize(self,path)
+
+    def list_folder(self,path):
+        self.benchstats.request()
+        path = self._realpath(path)
+        try:
+            out = []
+            for fname in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.stat(os.path.join(path,fname)))
+                attr.filename = fname
+                out.append(attr)
+            return out
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self,path):
+        self.benchstats.request()
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._realpath(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self,path):
+        self.benchstats.request()
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self._realpath(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self,path,flags,attr):
+        self.benchstats.request()
+        path = self._realpath(path)
+        try:
+            fd = os.open(path,flags,0o666)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            fstr = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            fstr = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            fstr = 'rb'
+        f = os.fdopen(fd,fstr)
+        h = benchhandle(flags)
+        h.benchstats = self.benchstats
+        h.filename = path
+        h.readfile = f
+        h.writefile = f
+        return h
+
+    def remove(self,path):
+        self.benchstats.request()
+        try:
+            os.remove(self._realpath(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self,oldpath,newpath):
+        self.benchstats.request()
+        try:
+            os.rename(self._realpath(oldpath),self._realpath(newpath))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def posix_rename(self,oldpath,newpath):
+        return self.rename(oldpath,newpath)
+
+    def mkdir(self,path,attr):
+        self.benchstats.request()
+        try:
+            os.mkdir(self._realpath(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rmdir(self,path):
+        self.benchstats.request()
+        try:
+            os.rmdir(self._realpath(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def chattr(self,path,attr):
+        self.benchstats.request()
+        try:
+            SFTPServer.set_file_attr(self._realpath(path),attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+##############################################################################
+## Accept any login
+##############################################################################
+class benchauth(paramiko.ServerInterface):
+
+    def check_auth_password(self,username,password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self,username,key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self,kind,chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def get_allowed_auths(self,username):
+        return 'password,publickey'
+
+##############################################################################
+## server class, listens on 127.0.0.1 in a background thread
+##############################################################################
+class server:
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class, "root" is the served directory
+    def __init__(self,root,latency=0.0,bandwidth=0):
+        self.stats = stats(root,latency,bandwidth)
+        self.key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        self.sock.bind(('127.0.0.1',0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+        self.running = True
+        self.thread = threading.Thread(target=self.__accept,daemon=True)
+        self.thread.start()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Accept connections
+    def __accept(self):
+        while self.running:
+            try:
+                (conn,addr) = self.sock.accept()
+            except OSError:
+                break
+            t = paramiko.Transport(conn)
+            t.add_server_key(self.key)
+            t.set_subsystem_handler('sftp',SFTPServer,benchsftp,self.stats)
+            t.start_server(server=benchauth())
+            self.transports.append(t)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Stop server
+    def close(self):
+        self.running = False
+        self.sock.close()
+        for t in self.transports:
+            t.close()
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+# Long running version of customer.py. Connections are kept open, the "from"
+# directory of each set is watched with inotify and new or changed files are
+# uploaded once they have stopped changing. A full rescan of all sets is done
+# every "rescan" seconds as a safety net.
+# The watch is a coarse trigger: only the top level of "from" is watched and
+# the files of an event are run through the filters of the set like any other
+# run (so an event of a filtered file uploads nothing). A type 3 set is
+# mirrored whole on an event of its top level, changes deeper in the tree are
+# found by the rescan. Type 4 sets ("from" is remote) run on the rescan only.
+#
+#   customerd.py [inifile]      (default customer.ini next to this file)
+
+from sstransfer import customer,dirwatch
+import sys
+import os
+import signal
+import time
+from datetime import datetime
+
+# Get full application filename
+appname = os.path.abspath(sys.argv[0])
+
+# Read settings from .ini file, setup logging to file (and MySQL)
+if len(sys.argv) > 1:
+    inifile = os.path.abspath(sys.argv[1])
+else:
+    inifile = os.path.join(os.path.dirname(appname),'customer.ini')
+c = customer(inifile=inifile)
+if not c.ok:
+    # Failed to read settings or create log path
+    sys.exit(990)
+s = c.s
+log = c.log
+
+# Start of logging
+log.logInfo('Start daemon --> (Python v{ver})'.format(ver=sys.version.split(' ')[0]))
+
+# Daemon options
+settle = s.getInt('daemon','settle',2)          # seconds a file must be unchanged before upload
+rescan = s.getInt('daemon','rescan',300)        # seconds between full rescans
+
+# Stop on SIGTERM/SIGINT
+running = True
+def stop(signum,frame):
+    global running
+    running = False
+signal.signal(signal.SIGTERM,stop)
+signal.signal(signal.SIGINT,stop)
+
+# Watch "from" directory of each set
+sections = c.getSets()
+watch = dirwatch(settle)
+if not watch.isActive():
+    log.logWarning('inotify not available, using rescan only')
+for section in sections:
+    if s.getString(section,'type','1') == '4':
+        # Remote source, can't be watched
+        continue
+    pathFrom = s.getString(section,'from','')
+    if watch.isActive() and not watch.add(pathFrom,section):
+        log.logError('Failed to watch {d} of {k}'.format(d=pathFrom,k=section))
+
+# Run all sets
+def runAll():
+    c.keepAlive()
+    ts = datetime.now()
+    for section in sections:
+        c.runSet(section,ts=ts)
+
+runAll()
+lastRescan = time.time()
+while running:
+    ready = watch.poll(1.0)
+    if ready == False:
+        # Events were lost
+        log.logWarning('Watch queue overflow, rescanning')
+        runAll()
+        lastRescan = time.time()
+        continue
+    if len(ready) > 0:
+        c.keepAlive()
+        ts = datetime.now()
+        for section in sections:
+            if section in ready:
+                c.runSet(section,ready[section],ts)
+    if time.time() - lastRescan >= rescan:
+        runAll()
+        lastRescan = time.time()
+
+# Disconnect sftp, close local state database and end logging
+watch.close()
+c.close('<---- End daemon')
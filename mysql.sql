@@ -6,13 +6,16 @@ USE `transfers`;
 CREATE TABLE IF NOT EXISTS `customers` (
   `idcust` tinyint(4) NOT NULL AUTO_INCREMENT,
   `customer` varchar(200) NOT NULL,
-  `ena` tinyint(4) NOT NULL,
-  `alarmlimitsec` int(11) NOT NULL,
-  `emailalarm` text NOT NULL,
-  PRIMARY KEY (`idcust`)
+  `ena` tinyint(4) NOT NULL DEFAULT '1',
+  `alarmlimitsec` int(11) NOT NULL DEFAULT '0',
+  `emailalarm` text,
+  PRIMARY KEY (`idcust`),
+  UNIQUE KEY `idx_customer` (`customer`)
 ) ENGINE=InnoDB;
 
 -- Create table files
+-- Partitioned by month of tsstart, so old months can be dropped without deleting rows (see prunepartitions).
+-- The partition column has to be part of the primary key.
 CREATE TABLE IF NOT EXISTS `files` (
   `idfiles` int(11) NOT NULL AUTO_INCREMENT,
   `idcust` tinyint(4) NOT NULL,
@@ -21,38 +24,58 @@ CREATE TABLE IF NOT EXISTS `files` (
   `fromfile` blob NOT NULL,
   `tofile` blob NOT NULL,
   `status` enum('U','F','S','C') NOT NULL,
-  PRIMARY KEY (`idfiles`)
-) ENGINE=InnoDB;
+  PRIMARY KEY (`idfiles`,`tsstart`),
+  KEY `idx_custtsstatus` (`idcust`,`tsstart`,`status`)
+) ENGINE=InnoDB
+PARTITION BY RANGE (UNIX_TIMESTAMP(`tsstart`)) (
+  PARTITION pmax VALUES LESS THAN MAXVALUE
+);
 
 -- Create table log
+-- Partitioned by month of ts as files
 CREATE TABLE IF NOT EXISTS `log` (
   `idlog` int(11) NOT NULL AUTO_INCREMENT,
   `ts` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
   `idcust` tinyint(4) NOT NULL DEFAULT '0',
   `msg` blob,
   `etype` enum('I','E') NOT NULL,
-  PRIMARY KEY (`idlog`),
+  PRIMARY KEY (`idlog`,`ts`),
   KEY `idx_tscust` (`idcust`,`ts`)
-) ENGINE=InnoDB;
+) ENGINE=InnoDB
+PARTITION BY RANGE (UNIX_TIMESTAMP(`ts`)) (
+  PARTITION pmax VALUES LESS THAN MAXVALUE
+);
+
+-- Create procedure getcust
+-- Id of customer "cust", the customer is added when not known
+DROP PROCEDURE IF EXISTS `getcust`;
+DELIMITER //
+CREATE PROCEDURE `getcust`(cust VARCHAR(100), OUT idc TINYINT)
+BEGIN
+    SET idc = 0;
+    SELECT idcust INTO idc FROM customers WHERE customer=cust;
+    IF idc = 0 THEN
+        INSERT INTO customers (customer) VALUES (cust) ON DUPLICATE KEY UPDATE idcust=LAST_INSERT_ID(idcust);
+        SET idc = LAST_INSERT_ID();
+    END IF;
+END//
+DELIMITER ;
 
 -- Create procedure logerror
+DROP PROCEDURE IF EXISTS `logerror`;
 DELIMITER //
 CREATE PROCEDURE `logerror`(cust VARCHAR(100),msg BLOB)
 BEGIN
     DECLARE idc TINYINT DEFAULT 0;
-    DECLARE x INT DEFAULT 0;
-    
-    SELECT COUNT(idcust) INTO x FROM customers WHERE customer=cust;
-    IF x = 0 THEN
-        INSERT INTO customers (customer) VALUES (cust);
-    END IF;
-    SELECT idcust INTO idc FROM customers WHERE customer=cust;
+
+    CALL getcust(cust,idc);
     INSERT INTO log (idcust,msg,etype) VALUES (idc,msg,"E");
     SELECT 0;
 END//
 DELIMITER ;
 
 -- Create procedure logfileC
+DROP PROCEDURE IF EXISTS `logfileC`;
 DELIMITER //
 CREATE PROCEDURE `logfileC`(i INT)
 BEGIN
@@ -61,6 +84,7 @@ END//
 DELIMITER ;
 
 -- Create procedure logfileF
+DROP PROCEDURE IF EXISTS `logfileF`;
 DELIMITER //
 CREATE PROCEDURE `logfileF`(i INT)
 BEGIN
@@ -69,6 +93,7 @@ END//
 DELIMITER ;
 
 -- Create procedure logfileS
+DROP PROCEDURE IF EXISTS `logfileS`;
 DELIMITER //
 CREATE PROCEDURE `logfileS`(i INT)
 BEGIN
@@ -77,35 +102,103 @@ END//
 DELIMITER ;
 
 -- Create procedure logfileU
+DROP PROCEDURE IF EXISTS `logfileU`;
 DELIMITER //
 CREATE PROCEDURE `logfileU`(cust VARCHAR(100),ffile BLOB,tfile BLOB, OUT xid INT)
 BEGIN
     DECLARE idc TINYINT DEFAULT 0;
-    DECLARE x INT DEFAULT 0;
-    
-    SELECT COUNT(idcust) INTO x FROM customers WHERE customer=cust;
-    IF x = 0 THEN
-        INSERT INTO customers (customer) VALUES (cust);
-    END IF;
-    SELECT idcust INTO idc FROM customers WHERE customer=cust;
+
+    CALL getcust(cust,idc);
     INSERT INTO files (idcust,tsstart,tsend,fromfile,tofile,status) VALUES (idc,NOW(),'00000000000000',ffile,tfile,"U");
     SET xid=LAST_INSERT_ID();
 END//
 DELIMITER ;
 
 -- Create procedure loginfo
+DROP PROCEDURE IF EXISTS `loginfo`;
 DELIMITER //
 CREATE PROCEDURE `loginfo`(cust VARCHAR(100),msg BLOB)
 BEGIN
     DECLARE idc TINYINT DEFAULT 0;
+
+    CALL getcust(cust,idc);
+    INSERT INTO log (idcust,msg,etype) VALUES (idc,msg,"I");
+    SELECT 0;
+END//
+DELIMITER ;
+
+-- Create procedure addpartitions
+-- Add monthly partitions to table "tbl" up to "months" months ahead, starting at the month of "fromdate"
+-- or after the last partition. New partitions are split off the empty "pmax" partition, which is cheap.
+-- Tables without partitions are left alone.
+DROP PROCEDURE IF EXISTS `addpartitions`;
+DELIMITER //
+CREATE PROCEDURE `addpartitions`(tbl VARCHAR(64),fromdate DATE,months INT)
+proc: BEGIN
     DECLARE x INT DEFAULT 0;
-    
-    SELECT COUNT(idcust) INTO x FROM customers WHERE customer=cust;
+    DECLARE lastbound BIGINT DEFAULT 0;
+    DECLARE m DATE;
+    DECLARE upto DATE;
+
+    SELECT COUNT(*) INTO x FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=tbl AND PARTITION_NAME='pmax';
     IF x = 0 THEN
-        INSERT INTO customers (customer) VALUES (cust);
+        LEAVE proc;
+    END IF;
+    SELECT IFNULL(MAX(CAST(PARTITION_DESCRIPTION AS UNSIGNED)),0) INTO lastbound FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=tbl AND PARTITION_DESCRIPTION<>'MAXVALUE';
+    IF lastbound > 0 THEN
+        SET m = DATE(FROM_UNIXTIME(lastbound));
+    ELSE
+        SET m = DATE_FORMAT(fromdate,'%Y-%m-01');
+    END IF;
+    SET upto = DATE_ADD(DATE_FORMAT(NOW(),'%Y-%m-01'),INTERVAL months MONTH);
+    WHILE m <= upto DO
+        SET @sql = CONCAT('ALTER TABLE `',tbl,'` REORGANIZE PARTITION pmax INTO (PARTITION p',DATE_FORMAT(m,'%Y%m'),
+            ' VALUES LESS THAN (',UNIX_TIMESTAMP(DATE_ADD(m,INTERVAL 1 MONTH)),'), PARTITION pmax VALUES LESS THAN MAXVALUE)');
+        PREPARE stmt FROM @sql;
+        EXECUTE stmt;
+        DEALLOCATE PREPARE stmt;
+        SET m = DATE_ADD(m,INTERVAL 1 MONTH);
+    END WHILE;
+END//
+DELIMITER ;
+
+-- Create procedure prunepartitions
+-- Drop monthly partitions of table "tbl" older than "keepmonths" months (whole months, no row deletes)
+DROP PROCEDURE IF EXISTS `prunepartitions`;
+DELIMITER //
+CREATE PROCEDURE `prunepartitions`(tbl VARCHAR(64),keepmonths INT)
+BEGIN
+    DECLARE parts TEXT DEFAULT NULL;
+
+    SELECT GROUP_CONCAT(PARTITION_NAME) INTO parts FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=tbl AND PARTITION_DESCRIPTION<>'MAXVALUE'
+        AND CAST(PARTITION_DESCRIPTION AS UNSIGNED) <= UNIX_TIMESTAMP(DATE_SUB(DATE_FORMAT(NOW(),'%Y-%m-01'),INTERVAL keepmonths MONTH));
+    IF parts IS NOT NULL THEN
+        SET @sql = CONCAT('ALTER TABLE `',tbl,'` DROP PARTITION ',parts);
+        PREPARE stmt FROM @sql;
+        EXECUTE stmt;
+        DEALLOCATE PREPARE stmt;
     END IF;
-    SELECT idcust INTO idc FROM customers WHERE customer=cust;
-    INSERT INTO log (idcust,msg,etype) VALUES (idc,msg,"I");
-    SELECT 0;
 END//
 DELIMITER ;
+
+-- Create procedure maintainpartitions
+-- Keep 3 months of partitions ahead and "keepmonths" months of history in log and files
+DROP PROCEDURE IF EXISTS `maintainpartitions`;
+DELIMITER //
+CREATE PROCEDURE `maintainpartitions`(keepmonths INT)
+BEGIN
+    CALL addpartitions('log',NOW(),3);
+    CALL addpartitions('files',NOW(),3);
+    CALL prunepartitions('log',keepmonths);
+    CALL prunepartitions('files',keepmonths);
+END//
+DELIMITER ;
+
+-- Initial partitions
+CALL maintainpartitions(12);
+
+-- Run partition maintenance daily (needs event_scheduler=ON)
+CREATE EVENT IF NOT EXISTS `ev_maintainpartitions` ON SCHEDULE EVERY 1 DAY DO CALL maintainpartitions(12);
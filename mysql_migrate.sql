@@ -0,0 +1,61 @@
+-- Migrate log and files tables of an existing "transfers" database to the partitioned layout of mysql.sql
+--
+-- 1. Stop the transfers (cron / customerd.py), events logged during the copy would be lost otherwise.
+--    Runs which can't reach the database keep their events in "<logfile>.spill" and write them later.
+-- 2. mysql < mysql.sql            (new procedures, existing tables are kept as they are)
+-- 3. mysql < mysql_migrate.sql
+-- 4. Check the new tables, then drop log_old and files_old.
+USE `transfers`;
+
+-- Customers: defaults for columns the logging procedures don't set, one row per customer name
+ALTER TABLE `customers`
+  MODIFY `ena` tinyint(4) NOT NULL DEFAULT '1',
+  MODIFY `alarmlimitsec` int(11) NOT NULL DEFAULT '0',
+  MODIFY `emailalarm` text,
+  ADD UNIQUE KEY `idx_customer` (`customer`);
+
+-- New files table
+CREATE TABLE `files_new` (
+  `idfiles` int(11) NOT NULL AUTO_INCREMENT,
+  `idcust` tinyint(4) NOT NULL,
+  `tsstart` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `tsend` timestamp NOT NULL DEFAULT '0000-00-00 00:00:00',
+  `fromfile` blob NOT NULL,
+  `tofile` blob NOT NULL,
+  `status` enum('U','F','S','C') NOT NULL,
+  PRIMARY KEY (`idfiles`,`tsstart`),
+  KEY `idx_custtsstatus` (`idcust`,`tsstart`,`status`)
+) ENGINE=InnoDB
+PARTITION BY RANGE (UNIX_TIMESTAMP(`tsstart`)) (
+  PARTITION pmax VALUES LESS THAN MAXVALUE
+);
+
+-- New log table
+CREATE TABLE `log_new` (
+  `idlog` int(11) NOT NULL AUTO_INCREMENT,
+  `ts` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `idcust` tinyint(4) NOT NULL DEFAULT '0',
+  `msg` blob,
+  `etype` enum('I','E') NOT NULL,
+  PRIMARY KEY (`idlog`,`ts`),
+  KEY `idx_tscust` (`idcust`,`ts`)
+) ENGINE=InnoDB
+PARTITION BY RANGE (UNIX_TIMESTAMP(`ts`)) (
+  PARTITION pmax VALUES LESS THAN MAXVALUE
+);
+
+-- Monthly partitions from the oldest row on (tables without rows start this month)
+SET @fromdate = (SELECT IFNULL(MIN(tsstart),NOW()) FROM `files` WHERE tsstart > 0);
+CALL addpartitions('files_new',@fromdate,3);
+SET @fromdate = (SELECT IFNULL(MIN(ts),NOW()) FROM `log` WHERE ts > 0);
+CALL addpartitions('log_new',@fromdate,3);
+
+-- Copy rows, ids are kept
+INSERT INTO `files_new` (idfiles,idcust,tsstart,tsend,fromfile,tofile,status)
+  SELECT idfiles,idcust,tsstart,tsend,fromfile,tofile,status FROM `files`;
+INSERT INTO `log_new` (idlog,ts,idcust,msg,etype)
+  SELECT idlog,ts,idcust,msg,etype FROM `log`;
+
+-- Swap tables
+RENAME TABLE `files` TO `files_old`, `files_new` TO `files`,
+             `log` TO `log_old`, `log_new` TO `log`;
@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+
+# Run many customers in one process. Each customer .ini file gets its own
+# settings, logging and transfers; the sets of all customers share one pool
+# of workers and are started round robin over the customers.
+# The number of sets a customer can run at the same time is "concurrency"
+# in the [setup] section of its .ini file (default 1).
+# "ratelimit" caps the uploads of all customers together (KB/s), next to the
+# "ratelimit" of each customer in [sftp].
+#
+#   runner.py [-w workers] [-r ratelimit] inifile|glob ...
+
+from sstransfer import customer,scheduler,ratelimit
+import sys
+import os
+import glob
+import argparse
+from datetime import datetime
+
+parser = argparse.ArgumentParser(description='Run sets of many customers')
+parser.add_argument('-w','--workers',type=int,default=os.cpu_count() or 4,help='sets running at the same time (all customers)')
+parser.add_argument('-r','--ratelimit',type=int,default=0,help='KB/s of uploads of all customers together (0 = unlimited)')
+parser.add_argument('inifiles',nargs='+',help='customer .ini files (wildcards allowed)')
+args = parser.parse_args()
+
+# Find the .ini files
+inifiles = []
+for pattern in args.inifiles:
+    for inifile in sorted(glob.glob(pattern)):
+        if inifile not in inifiles:
+            inifiles.append(inifile)
+
+# Setup customers, sharing the bandwidth cap of the run
+limit = ratelimit(args.ratelimit * 1024)
+customers = []
+for inifile in inifiles:
+    c = customer(inifile=inifile,limit=limit)
+    if not c.ok:
+        print('Failed to setup customer : {f}'.format(f=inifile))
+        continue
+    if not c.hasPending():
+        # Nothing to send, don't connect to remote or database
+        c.close('Nothing to send',db=False)
+        continue
+    c.log.logInfo('Start --> (Python v{ver})'.format(ver=sys.version.split(' ')[0]))
+    customers.append(c)
+
+# Run all sets of all customers
+scheduler(args.workers).run(customers,datetime.now())
+
+# Disconnect, end logging and write remaining database log events
+for c in customers:
+    c.close()
@@ -2,18 +2,31 @@
 
 # sudo pip3 install mysql-connector==2.1.6
 # sudo pip3 install pysftp
+#
+# Backends (pysftp, asyncssh, mysql.connector, sqlite3) are imported when first used,
+# so a run with nothing to send doesn't pay for loading them.
 
 import logging
 import logging.handlers
-import pysftp
 import os
 import configparser
 import sys
-import inspect
-import mysql.connector
 import shutil
+import posixpath
 import re
-import sqlite3
+import queue
+import threading
+import concurrent.futures
+import fnmatch
+import time
+import json
+import hashlib
+import stat
+import select
+import struct
+import collections
+import tarfile
+import uuid
 from datetime import datetime
 
 ##############################################################################
@@ -69,6 +82,699 @@ class settings:
             else:
                 return default
 
+##############################################################################
+## filefilter class
+## Filtering of files of a set, compiled once per set:
+##  extinc/extexc => comma separated extensions, "csv:txt" renames csv to txt on upload
+##  globinc/globexc => comma separated glob patterns (report_*.csv), case sensitive
+##  regexinc/regexexc => regular expression searched in the filename, case sensitive unless (?i) is used
+##  minsize/maxsize => file size in bytes (0 = no limit)
+##  minage/maxage => seconds since file was last modified (0 = no limit)
+## Exclude filtering overrides include filtering.
+##############################################################################
+class filefilter:
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class
+    def __init__(self,extInc='',extExc='',globInc='',globExc='',regexInc='',regexExc='',minSize=0,maxSize=0,minAge=0,maxAge=0):
+        # Extension lookup tables, extension (lowercase) => (order,new extension)
+        self.extInc = self.__parseExt(extInc)
+        self.extExc = self.__parseExt(extExc)
+        # Glob patterns combined into one regex, (globs,regex) each; re.error raised for a bad regex
+        self.patInc = self.__compile(globInc,regexInc)
+        self.patExc = self.__compile(globExc,regexExc)
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.minAge = minAge
+        self.maxAge = maxAge
+        self.now = time.time()
+        self.needStat = (minSize > 0) or (maxSize > 0) or (minAge > 0) or (maxAge > 0)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # "txt,csv:txt" => {'txt': (0,''), 'csv': (1,'txt')}
+    def __parseExt(self,extFilter):
+        exts = {}
+        for ext in extFilter.split(','):
+            extc = ext.strip().split(':')
+            e = extc[0].strip().lower()
+            if e != '' and e not in exts:
+                exts[e] = (len(exts),extc[1].strip() if len(extc) > 1 else '')
+        return exts
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Compile comma separated globs into one regex and the regex on its own (kept apart so its inline
+    # flags work), returns (globs,regex) with None for each not given, or None if nothing to match
+    def __compile(self,globs='',regex=''):
+        pats = ['(?:{p})'.format(p=fnmatch.translate(g.strip())) for g in globs.split(',') if g.strip() != '']
+        globre = re.compile('|'.join(pats)) if len(pats) > 0 else None
+        regexre = re.compile(regex) if regex != '' else None
+        if (globre is None) and (regexre is None):
+            return None
+        return (globre,regexre)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # True if filename matches the globs or the regex (searched anywhere in filename) of "pat"
+    def __matchPat(self,pat,sfile):
+        if (pat[0] is not None) and pat[0].match(sfile):
+            return True
+        return (pat[1] is not None) and (pat[1].search(sfile) is not None)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Find the matching extension in lookup table, the first listed extension wins
+    # Returns (order,new extension) or None
+    def __matchExt(self,exts,sfile):
+        found = None
+        i = sfile.find('.')
+        while i >= 0:
+            m = exts.get(sfile[i+1:].lower())
+            if (m is not None) and ((found is None) or (m[0] < found[0])):
+                found = m
+            i = sfile.find('.',i+1)
+        return found
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Check size/age of file, "st" is a os.stat result (or a os.DirEntry)
+    def __checkStat(self,st):
+        if not self.needStat:
+            return True
+        if isinstance(st,os.DirEntry):
+            st = st.stat()
+        if (self.minSize > 0) and (st.st_size < self.minSize):
+            return False
+        if (self.maxSize > 0) and (st.st_size > self.maxSize):
+            return False
+        age = self.now - st.st_mtime
+        if (self.minAge > 0) and (age < self.minAge):
+            return False
+        if (self.maxAge > 0) and (age > self.maxAge):
+            return False
+        return True
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Exclude files
+    # False if excluded, True if included
+    def checkExclude(self,sfile='',st=None):
+        if (len(self.extExc) > 0) and (self.__matchExt(self.extExc,sfile) is not None):
+            return False
+        if (self.patExc is not None) and self.__matchPat(self.patExc,sfile):
+            return False
+        if st is not None:
+            return self.__checkStat(st)
+        return True
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Include files
+    # Returns tuple (stat,filename):
+    #  stat => False if excluded, True if included
+    #  filename => The extension can be changed during upload. This is the name of the file as uploaded.
+    def checkInclude(self,sfile=''):
+        if (len(self.extInc) == 0) and (self.patInc is None):
+            # no filtering => include
+            return (True,sfile)
+        if len(self.extInc) > 0:
+            m = self.__matchExt(self.extInc,sfile)
+            if m is not None:
+                # extension matched => include
+                if m[1] != '':
+                    # change extension of file
+                    return (True,'{f}.{e}'.format(f=os.path.splitext(sfile)[0],e=m[1]))
+                return (True,sfile)
+        if (self.patInc is not None) and self.__matchPat(self.patInc,sfile):
+            return (True,sfile)
+        # Nothing matched => exclude
+        return (False,sfile)
+
+##############################################################################
+## remotecache class
+## Remote directories known to exist and the current remote directory of each
+## connection, kept for one run. Counts the remote round trips saved.
+##############################################################################
+class remotecache:
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirs = set()
+        self.pwds = {}          # id(conn) => remote directory
+        self.roundTripsSaved = 0
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Get cached current directory of connection, '' if not known
+    def getPwd(self,conn):
+        with self.lock:
+            return self.pwds.get(id(conn),'')
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Set current directory of connection
+    def setPwd(self,conn,path):
+        with self.lock:
+            self.pwds[id(conn)] = path
+            self.dirs.add(path)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # True if remote directory is known to exist
+    def hasDir(self,path):
+        with self.lock:
+            return path in self.dirs
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Mark remote directory (and its parents) as existing
+    def addDir(self,path):
+        with self.lock:
+            while path not in ('','/') and path not in self.dirs:
+                self.dirs.add(path)
+                path = path.rsplit('/',1)[0]
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Forget what is known about a connection, or everything if conn not given. With "path" the
+    # directory (and its subdirectories) is no longer known to exist, it may have been removed.
+    def invalidate(self,conn=False,path=''):
+        with self.lock:
+            if conn == False:
+                self.dirs = set()
+                self.pwds = {}
+            else:
+                self.pwds.pop(id(conn),None)
+            if path != '':
+                self.dirs = set(d for d in self.dirs if (d != path) and not d.startswith(path + '/'))
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Count saved round trips
+    def saved(self,n=1):
+        with self.lock:
+            self.roundTripsSaved += n
+
+##############################################################################
+## metrics class
+## Timers and counters of a run, per set. Timings are kept as histograms of
+## each phase (connect, remote_dir, put, verify, sqlite, scan, log, db).
+## When not enabled start/stop/count return at once, so a disabled instance
+## costs next to nothing. Exported at end of run as a Prometheus textfile
+## (filename ending .prom) or a json report.
+##############################################################################
+class metrics:
+    buckets = (0.001,0.005,0.01,0.05,0.1,0.5,1.0,5.0,10.0,60.0)
+    enabled = False
+    sid = ''
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class
+    def __init__(self,enabled=False,sid=''):
+        self.enabled = enabled
+        self.sid = sid
+        self.lock = threading.Lock()
+        self.timers = {}        # (set,phase) => [count per bucket..., +Inf count, sum]
+        self.counters = {}      # (name,set) => value
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Start a timer, returns value for "stop"
+    def start(self):
+        if not self.enabled:
+            return 0
+        return time.perf_counter()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Stop a timer started with "start" and add the time to "phase" of "section"
+    def stop(self,t,phase,section=''):
+        if not self.enabled:
+            return
+        self.observe(phase,section,time.perf_counter() - t)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Add time since "t" (from "start") to "acc", used to time code which is suspended in between (generators)
+    def lap(self,t,acc=0.0):
+        if not self.enabled:
+            return 0.0
+        return acc + time.perf_counter() - t
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Add "seconds" into histogram of "phase"
+    def observe(self,phase,section,seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            h = self.timers.get((section,phase))
+            if h is None:
+                h = [0] * (len(self.buckets) + 2)
+                self.timers[(section,phase)] = h
+            for i in range(len(self.buckets)):
+                if seconds <= self.buckets[i]:
+                    h[i] += 1
+            h[-2] += 1
+            h[-1] += seconds
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Add "value" to counter "name" of "section"
+    def count(self,name,section='',value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[(name,section)] = self.counters.get((name,section),0) + value
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Write metrics into "filename" (written to a temporary file first and then renamed)
+    def export(self,filename):
+        if (not self.enabled) or (filename == ''):
+            return
+        with self.lock:
+            if filename.endswith('.prom'):
+                data = self.__prometheus()
+            else:
+                data = json.dumps(self.__report(),indent=2)
+        tmpfile = filename + '.tmp'
+        with open(tmpfile,'w') as f:
+            f.write(data)
+        os.replace(tmpfile,filename)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Prometheus text format
+    def __prometheus(self):
+        out = []
+        out.append('# TYPE ctransfer_phase_seconds histogram')
+        for (section,phase) in sorted(self.timers):
+            h = self.timers[(section,phase)]
+            labels = 'sid="{sid}",set="{k}",phase="{p}"'.format(sid=self.sid,k=section,p=phase)
+            for i in range(len(self.buckets)):
+                out.append('ctransfer_phase_seconds_bucket{{{l},le="{b}"}} {v}'.format(l=labels,b=self.buckets[i],v=h[i]))
+            out.append('ctransfer_phase_seconds_bucket{{{l},le="+Inf"}} {v}'.format(l=labels,v=h[-2]))
+            out.append('ctransfer_phase_seconds_sum{{{l}}} {v}'.format(l=labels,v=round(h[-1],6)))
+            out.append('ctransfer_phase_seconds_count{{{l}}} {v}'.format(l=labels,v=h[-2]))
+        names = sorted(set(name for (name,section) in self.counters))
+        for name in names:
+            out.append('# TYPE ctransfer_{n}_total counter'.format(n=name))
+            for (n,section) in sorted(self.counters):
+                if n == name:
+                    out.append('ctransfer_{n}_total{{sid="{sid}",set="{k}"}} {v}'.format(n=name,sid=self.sid,k=section,v=self.counters[(n,section)]))
+        return '\n'.join(out) + '\n'
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Json report, per set and totals of the run
+    def __report(self):
+        report = {'sid': self.sid, 'ts': datetime.now().isoformat(timespec='seconds'), 'sets': {}, 'run': {'phases': {}, 'counters': {}}}
+        for (section,phase) in sorted(self.timers):
+            h = self.timers[(section,phase)]
+            r = report['sets'].setdefault(section,{'phases': {}, 'counters': {}})
+            r['phases'][phase] = {'count': h[-2], 'seconds': round(h[-1],6), 'buckets': dict(zip([str(b) for b in self.buckets],h[:len(self.buckets)]))}
+            t = report['run']['phases'].setdefault(phase,{'count': 0, 'seconds': 0.0})
+            t['count'] += h[-2]
+            t['seconds'] = round(t['seconds'] + h[-1],6)
+        for (name,section) in sorted(self.counters):
+            r = report['sets'].setdefault(section,{'phases': {}, 'counters': {}})
+            r['counters'][name] = self.counters[(name,section)]
+            report['run']['counters'][name] = report['run']['counters'].get(name,0) + self.counters[(name,section)]
+        return report
+
+##############################################################################
+## ratelimit class
+## Token bucket capping the bytes per second of uploads. "rate" tokens (bytes)
+## are added each second, up to a quarter second of them, and a write takes as
+## many as it has bytes, waiting when there are not enough. A limit can have a
+## "parent" (limit of the customer or of the whole run) which is taken from as
+## well. Limits made with "child" share the rate of the parent by "weight"
+## with the other children running at the same time (the sets of a customer).
+##############################################################################
+class ratelimit:
+    rate = 0                # bytes per second, 0 = unlimited
+    parent = None
+    weight = 1
+    shared = False          # registered as child of parent (gets a share of its rate)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class
+    def __init__(self,rate=0,parent=None,weight=1):
+        self.rate = max(0,rate)
+        self.parent = parent
+        self.weight = max(1,weight)
+        self.shared = False
+        self.lock = threading.Lock()
+        self.children = []
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.started = self.last
+        self.bytes = 0
+        self.waited = 0.0
+
+    # ---------------------------------------------------------------------------------------------------------
+    # New limit of "rate" (0 = only the share of this one) sharing this rate by "weight", release when done
+    def child(self,rate=0,weight=1):
+        c = ratelimit(rate,self,weight)
+        c.shared = True
+        with self.lock:
+            self.children.append(c)
+        return c
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Stop sharing the rate of parent
+    def release(self):
+        if self.shared:
+            with self.parent.lock:
+                if self in self.parent.children:
+                    self.parent.children.remove(self)
+            self.shared = False
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Bytes per second allowed now, 0 = unlimited
+    def getRate(self):
+        rate = self.rate
+        if self.parent is not None:
+            prate = self.parent.getRate()
+            if prate > 0:
+                if self.shared:
+                    with self.parent.lock:
+                        total = sum(c.weight for c in self.parent.children)
+                    prate = prate * self.weight / max(1,total)
+                rate = prate if rate == 0 else min(rate,prate)
+        return rate
+
+    # ---------------------------------------------------------------------------------------------------------
+    # True if this limit or a parent has a rate
+    def active(self):
+        return (self.rate > 0) or ((self.parent is not None) and self.parent.active())
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Take "n" bytes, waits until the bucket (and the bucket of parent) allows them
+    def take(self,n):
+        wait = 0.0
+        rate = self.getRate()
+        if rate > 0:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(rate / 4,self.tokens + (now - self.last) * rate)
+                self.last = now
+                # Take now and wait for the debt, so writers waiting at the same time queue up
+                self.tokens -= n
+                if self.tokens < 0:
+                    wait = -self.tokens / rate
+            if wait > 0:
+                time.sleep(wait)
+        with self.lock:
+            self.bytes += n
+            self.waited += wait
+        if self.parent is not None:
+            self.parent.take(n)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Achieved rate since created: (bytes,seconds,bytes per second,seconds waited)
+    def report(self):
+        with self.lock:
+            t = max(0.001,time.monotonic() - self.started)
+            return (self.bytes,t,self.bytes / t,self.waited)
+
+##############################################################################
+## customer class
+## Everything needed to run the sets of one customer .ini file: settings,
+## logging and transfers. Up to "concurrency" sets can run at the same time,
+## each with its own transfer (connection) sharing the local state database.
+##############################################################################
+class customer:
+    ok = False
+    inifile = ''
+    basepath = ''
+    sid = ''
+    concurrency = 1
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class, "basepath" is used for relative paths (log, private key), defaults to directory of inifile.
+    # "limit" is a ratelimit shared with other customers (whole run), the uploads of this customer are
+    # capped by it as well as by "ratelimit" of [sftp].
+    def __init__(self,inifile='',basepath='',limit=None):
+        self.inifile = inifile
+        if basepath == '':
+            basepath = os.path.dirname(os.path.abspath(inifile))
+        self.basepath = basepath
+        self.s = settings(inifile=inifile)
+        self.ok = False
+        if self.s.config == False:
+            return
+
+        # Get SID (used to identify logging in database)
+        self.sid = self.s.getString('setup','sid','SID')
+        self.concurrency = max(1,self.s.getInt('setup','concurrency',1))
+
+        # Setup logging to file
+        logpath = self.s.getString('log','path',basepath)
+        logfile = self.s.getString('log','file','log.log')
+        if not os.path.exists(logpath):
+            os.makedirs(logpath)
+            if not os.path.exists(logpath):
+                # Failed to create log path
+                return
+        self.log = logoutput(
+            self.sid,os.path.join(logpath,logfile),
+            maxBytes=self.s.getInt('log','maxsize',500) * 1024,
+            backupCount=self.s.getInt('log','backups',10),
+            when=self.s.getString('log','rotate',''),
+            compress=self.s.getInt('log','compress',0) == 1
+        )
+        self.log.setDebug(False)     # Dont print to console
+
+        # .. and add log sinks (json lines, MySQL) having a section in the .ini file
+        for name in sorted(logsinks):
+            if self.s.sectionExists(name):
+                logsinks[name](self.log,self.s)
+
+        # Timing of phases, exported at close when [metrics] file is set
+        self.metricsFile = self.s.getString('metrics','file','')
+        self.metrics = metrics(self.metricsFile != '',self.sid)
+        self.log.setMetrics(self.metrics)
+
+        # Bandwidth cap of all sets, shared by weight between the sets running at the same time
+        self.limit = ratelimit(self.s.getInt('sftp','ratelimit',0) * 1024,limit)
+
+        # Transfers are created when needed, all share the same local state database
+        self.state = filestate('{sid}.db'.format(sid=self.sid))
+        self.transfers = queue.Queue()
+        self.created = []
+        self.ok = True
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Setup a new transfer (connection is opened when needed)
+    def __newTransfer(self):
+        tr = transfer(self.sid,self.log,self.basepath)
+        tr.setRemote(
+            host=self.s.getString('sftp','host',''),
+            port=self.s.getInt('sftp','port',22),
+            user=self.s.getString('sftp','user',''),
+            password=self.s.getString('sftp','password',''),
+            privkey=self.s.getString('sftp','key',''),
+            conntype=self.s.getString('sftp','conntype','sftp')
+        )
+        tr.setTuning(
+            blockSize=self.s.getInt('sftp','blocksize',32) * 1024,
+            window=self.s.getInt('sftp','window',0) * 1048576,
+            maxPacket=self.s.getInt('sftp','maxpacket',0) * 1024,
+            maxRequests=self.s.getInt('sftp','maxrequests',64)
+        )
+        tr.setState(self.state)
+        tr.setMetrics(self.metrics)
+        tr.setRateLimit(self.limit)
+        self.created.append(tr)
+        return tr
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Get a free transfer, create one if none is free
+    def getTransfer(self):
+        try:
+            return self.transfers.get_nowait()
+        except queue.Empty:
+            return self.__newTransfer()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Give transfer back after use
+    def releaseTransfer(self,tr):
+        self.transfers.put(tr)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Get all "set-" sections, highest "priority" first and in name order within the same priority
+    def getSets(self):
+        sets = [section for section in sorted(self.s.getSections()) if section[0:4] == 'set-']
+        return sorted(sets,key=lambda section: -self.s.getInt(section,'priority',0))
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Run a set, "files" limits the run to the given files
+    def runSet(self,section,files=False,ts=False):
+        tr = self.getTransfer()
+        try:
+            tr.updateTimeStamp(ts)
+            self.log.logInfo('Running {k} ..'.format(k=section))
+            tr.doSet(self.s,section,files)
+        finally:
+            self.releaseTransfer(tr)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # True if any set has files to send. Checks local files only, nothing is connected.
+    def hasPending(self):
+        tr = self.getTransfer()
+        try:
+            for section in self.getSets():
+                if tr.hasPending(self.s,section):
+                    return True
+            return False
+        finally:
+            self.releaseTransfer(tr)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Drop lost connections of all transfers
+    def keepAlive(self):
+        for tr in self.created:
+            tr.keepAlive()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Disconnect all transfers, close local state database, end logging with "msg" and write metrics.
+    # "db" False logs "msg" into the log file only.
+    def close(self,msg='<---- End',db=True):
+        for tr in self.created:
+            tr.close()
+        self.state.close()
+        if self.limit.rate > 0:
+            (n,t,r,w) = self.limit.report()
+            self.log.logInfo('Sent {n:.1f} MB at {r:.2f} MB/s (limit {l:.2f} MB/s, waited {w:.1f} s)'.format(
+                n=n / 1048576,r=r / 1048576,l=self.limit.rate / 1048576,w=w),db=db)
+
+        # Write metrics while the log can still report a failure
+        try:
+            self.metrics.export(self.metricsFile)
+        except Exception as e:
+            self.log.logError('Failed to write metrics : {f}: {e}'.format(f=self.metricsFile,e=e),db=db)
+
+        # End logging and write remaining database log events
+        self.log.logInfo(msg,db=db)
+        self.log.close()
+
+##############################################################################
+## scheduler class
+## Runs the sets of many customers on a shared pool of "workers" threads.
+## Sets are started round robin over the customers, so each customer gets its
+## turn, and a customer never runs more than its "concurrency" sets at once.
+##############################################################################
+class scheduler:
+    workers = 4
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class
+    def __init__(self,workers=4):
+        self.workers = max(1,workers)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Run all sets of "customers" (list of customer), returns when all are done
+    def run(self,customers,ts=False):
+        if ts == False:
+            ts = datetime.now()
+        pending = [(c,collections.deque(c.getSets())) for c in customers]
+        running = [0] * len(pending)
+        total = [0]
+        cond = threading.Condition()
+
+        def task(i,section):
+            c = pending[i][0]
+            try:
+                c.runSet(section,ts=ts)
+            except Exception as e:
+                c.log.logError('Caught exception: {c}: {e}'.format(c=e.__class__,e=e))
+            finally:
+                with cond:
+                    running[i] -= 1
+                    total[0] -= 1
+                    cond.notify()
+
+        nxt = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            with cond:
+                while True:
+                    if (total[0] == 0) and all(len(q) == 0 for (c,q) in pending):
+                        break
+                    # Start a set of the next customer in turn that may run one
+                    started = False
+                    if total[0] < self.workers:
+                        for k in range(len(pending)):
+                            i = (nxt + k) % len(pending)
+                            (c,q) = pending[i]
+                            if (len(q) > 0) and (running[i] < c.concurrency):
+                                running[i] += 1
+                                total[0] += 1
+                                executor.submit(task,i,q.popleft())
+                                nxt = (i + 1) % len(pending)
+                                started = True
+                                break
+                    if not started:
+                        cond.wait()
+
+##############################################################################
+## transport registry
+## Connection types of transfer ("conntype") by name. "opener(tr)" returns a
+## new connection for transfer "tr" with the part of the pysftp.Connection
+## interface transfer uses, or raises an exception. The library of a transport
+## is imported by its opener, so only the one used is loaded.
+##############################################################################
+transports = {}
+
+# ---------------------------------------------------------------------------------------------------------
+# Register transport "name"
+def registerTransport(name,opener):
+    transports[name] = opener
+
+# ---------------------------------------------------------------------------------------------------------
+# sftp with pysftp, each connection is its own SSH session
+def openSftp(tr):
+    import pysftp
+
+    # TODO: For now we disable hostkey checking, should be on ...
+    cnopts = pysftp.CnOpts()
+    cnopts.hostkeys = None
+
+    ppk = tr.getKeyFile()
+    if ppk == '':
+        # Auth with user/password
+        tr.logclass.logInfo('Auth with password')
+        conn = pysftp.Connection(tr.host,username=tr.username,password=tr.password,port=tr.port,cnopts=cnopts)
+    else:
+        # Auth with user/privkey
+        tr.logclass.logInfo('Auth with private key')
+        conn = pysftp.Connection(tr.host,username=tr.username,private_key=ppk,port=tr.port,cnopts=cnopts)
+
+    # Set window and packet size. pysftp opens the sftp channel on first use, so the defaults of the
+    # transport are still used for it.
+    transport = getattr(conn,'_transport',None)
+    if transport is not None:
+        if tr.window > 0:
+            transport.default_window_size = tr.window
+        if tr.maxPacket > 0:
+            transport.default_max_packet_size = tr.maxPacket
+    return conn
+
+# ---------------------------------------------------------------------------------------------------------
+# sftp with asyncssh, a view on the engine of the transfer. The SSH session is opened once and
+# shared by all views.
+def openAsyncSftp(tr):
+    with tr.engineLock:
+        if (not tr.engine == False) and (not tr.engine.isAlive()):
+            tr.engine.close()
+            tr.engine = False
+        if tr.engine == False:
+            ppk = tr.getKeyFile()
+            tr.logclass.logInfo('Auth with {a}'.format(a='password' if ppk == '' else 'private key'))
+            engine = asyncengine(tr.host,tr.port,tr.username,tr.password,ppk)
+            engine.setTuning(tr.blockSize,tr.window,tr.maxPacket,tr.maxRequests)
+            try:
+                engine.connect()
+            except Exception:
+                engine.close()
+                raise
+            tr.engine = engine
+    return asyncconnection(tr.engine)
+
+# ---------------------------------------------------------------------------------------------------------
+# Local directory "host" as remote, for testing sets without a server
+def openLocal(tr):
+    if not os.path.isdir(tr.host):
+        raise IOError('Not a directory : {d}'.format(d=tr.host))
+    return localconnection(tr.host)
+
+registerTransport('sftp',openSftp)
+registerTransport('asyncsftp',openAsyncSftp)
+registerTransport('local',openLocal)
+
 ##############################################################################
 ## transfer class
 ## This is a "in-work" version and currently only sftp is supported
@@ -89,6 +795,60 @@ class transfer:
     pwd = ''
     sid = ''
     ts = ''
+    # asyncio engine (conntype asyncsftp)
+    engine = False
+    # parallel uploads
+    workers = 1
+    pool = False
+    queueDepth = 4          # queued jobs per worker between pipeline stages
+    # local state database
+    state = False
+    # remote directory cache
+    remote = False
+    # timing of phases, "section" is the set being run
+    metrics = False
+    section = ''
+    # verification of upload: none, size or hash
+    verify = 'size'
+    hashalg = 'sha256'
+    hashUnsupported = False
+    # tuning of uploads: bytes per write request, ssh channel window and packet size (0 = default),
+    # write requests waiting for an answer
+    blockSize = 32768
+    window = 0
+    maxPacket = 0
+    maxRequests = 64
+    boundRequests = None        # paramiko internals needed for "maxRequests" available (None = not checked)
+    # type 2 change detection: sqlite (local history) or remote (remote directory listing)
+    changeDetect = 'sqlite'
+    # large files are uploaded with temporary name and resume support
+    largeFile = 0
+    largeChunk = 8388608
+    # files which only grow are uploaded by appending the new bytes (type 2)
+    append = False
+    fingerprintBlock = 65536
+    # small files are sent as tar bundles: '' (off), tar or tar.gz
+    bundle = ''
+    bundleMax = 1048576         # files smaller than this are bundled
+    bundleFiles = 1000          # files per bundle
+    bundleSeq = 0
+    # failed uploads are retried with backoff (type 1 and 2): seconds of first wait, longest wait,
+    # failed attempts before a file is quarantined, retries per run
+    retryBase = 60
+    retryMax = 21600
+    retryLimit = 10
+    retryPerRun = 100
+    failures = False            # local file => reason of last failed upload
+    # bandwidth cap: "limits" is the parent (customer) ratelimit, "limit" the one of the set being run;
+    # order of files in a set: '' (directory order), smallest, oldest or deadline ("deadline" seconds after modification)
+    limits = False
+    limit = False
+    order = ''
+    deadline = 0
+    # more targets of a set (types 1 and 2): (name,transfer,remote path), each file is read once and
+    # streamed to the main remote and all targets; "fanout" keeps the transfer of each target section
+    targets = False
+    fanout = False
 
     # ---------------------------------------------------------------------------------------------------------
     # Init class
@@ -97,6 +857,19 @@ class transfer:
         self.logclass = logclass
         self.pwd = ''
         self.basepath = basepath
+        self.workers = 1
+        self.pool = queue.Queue()
+        self.engine = False
+        self.engineLock = threading.Lock()
+        self.state = False
+        self.remote = remotecache()
+        self.metrics = metrics()
+        self.section = ''
+        self.failures = {}
+        self.limits = ratelimit()
+        self.limit = self.limits
+        self.targets = []
+        self.fanout = {}
         self.updateTimeStamp()
 
     # ---------------------------------------------------------------------------------------------------------
@@ -108,318 +881,3049 @@ class transfer:
             self.ts = ts            
 
     # ---------------------------------------------------------------------------------------------------------
-    # Store remote settings
-    def setRemote(self,host='',port=22,user='',privkey='',password='',conntype='sftp'):
-        self.host=host
-        self.port=port
-        self.username=user
-        self.password=password
-        self.privkey=privkey
-        self.conntype=conntype
+    # Store remote settings
+    # conntype, a name in "transports":
+    #  sftp => pysftp, each worker has its own connection
+    #  asyncsftp => asyncssh, all workers share one SSH session with many uploads in flight
+    #  local => directory "host" of the local filesystem (for testing)
+    def setRemote(self,host='',port=22,user='',privkey='',password='',conntype='sftp'):
+        self.host=host
+        self.port=port
+        self.username=user
+        self.password=password
+        self.privkey=privkey
+        self.conntype=conntype
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Some directories have additional macros
+    def __chgPath(self,path):
+        # {date#1} => YYYYMMDD
+        return path.replace('{date#1}',self.ts.strftime('%Y%m%d'))
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Set verification of uploaded files:
+    #  none => no check
+    #  size => compare size returned by the upload (default)
+    #  hash => hash calculated during upload compared against remote hash (size if not supported by server)
+    def setVerify(self,verify='size',hashalg='sha256'):
+        if verify not in ('none','size','hash'):
+            self.logclass.logError('Unknown verify : {v}, using size'.format(v=verify),self.lineno())
+            verify = 'size'
+        try:
+            hashlib.new(hashalg)
+        except (ValueError,TypeError):
+            self.logclass.logError('Unknown hashalg : {h}, using sha256'.format(h=hashalg),self.lineno())
+            hashalg = 'sha256'
+        self.verify = verify
+        self.hashalg = hashalg
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Set how type 2 detects changed files:
+    #  sqlite => file modification time compared to the one stored in local database (default)
+    #  remote => size and modification time compared to the remote directory listing
+    def setChangeDetect(self,mode='sqlite'):
+        if mode not in ('sqlite','remote'):
+            self.logclass.logError('Unknown changedetect : {m}, using sqlite'.format(m=mode),self.lineno())
+            mode = 'sqlite'
+        self.changeDetect = mode
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Set size (bytes) from which files are uploaded with a temporary name and can be resumed (0 = disabled).
+    # Progress is stored every "chunk" bytes.
+    def setLargeFile(self,size=0,chunk=8388608):
+        self.largeFile = size
+        self.largeChunk = chunk
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Set append mode: a file which has only grown since its last upload gets just the new bytes appended
+    # on remote. Size and a fingerprint of the uploaded part are stored in the local state database.
+    def setAppend(self,append=False):
+        self.append = append
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Set bundling of small files (type 1 and type 2 with sqlite change detection):
+    #  bundle => '' (off), tar or tar.gz
+    #  bundleMax => files smaller than this many bytes are bundled, larger files are sent one by one
+    #  bundleFiles => most files in one bundle
+    def setBundle(self,bundle='',bundleMax=1048576,bundleFiles=1000):
+        if bundle not in ('','tar','tar.gz'):
+            self.logclass.logError('Unknown bundle : {b}, not bundling'.format(b=bundle),self.lineno())
+            bundle = ''
+        self.bundle = bundle
+        self.bundleMax = bundleMax
+        self.bundleFiles = max(2,bundleFiles)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Set ratelimit (bandwidth cap) shared by the sets this transfer runs
+    def setRateLimit(self,limits):
+        self.limits = limits
+        self.limit = limits
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Set order in which files of a set are uploaded (types 1 and 2):
+    #  '' => directory order, files are uploaded while the directory is read
+    #  smallest => smallest files first
+    #  oldest => oldest (modification time) files first
+    #  deadline => earliest deadline ("deadline" seconds after modification) first, files past it are reported
+    def setOrder(self,order='',deadline=0):
+        if order not in ('','smallest','oldest','deadline'):
+            self.logclass.logError('Unknown order : {o}'.format(o=order),self.lineno())
+            order = ''
+        self.order = order
+        self.deadline = deadline
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Set retry of failed uploads (type 1 and 2). A failed file is retried after "base" seconds, the wait is
+    # doubled after each failure up to "maxWait" seconds. After "limit" failed attempts the file is quarantined
+    # until it's changed. At most "perRun" retries are done in a run, after the other files.
+    def setRetry(self,base=60,maxWait=21600,limit=10,perRun=100):
+        self.retryBase = max(1,base)
+        self.retryMax = max(self.retryBase,maxWait)
+        self.retryLimit = max(1,limit)
+        self.retryPerRun = max(0,perRun)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Set tuning of uploads, used for connections opened after this:
+    #  blockSize => bytes per write request
+    #  window => ssh channel window in bytes (0 = default of library)
+    #  maxPacket => ssh channel max packet size in bytes (0 = default of library)
+    #  maxRequests => pipelined write requests waiting for an answer
+    def setTuning(self,blockSize=32768,window=0,maxPacket=0,maxRequests=64):
+        self.blockSize = max(1024,blockSize)
+        self.window = window
+        self.maxPacket = maxPacket
+        self.maxRequests = max(1,maxRequests)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Set number of parallel upload workers (each worker uses its own connection)
+    def setWorkers(self,workers=1):
+        if workers < 1:
+            workers = 1
+        self.workers = workers
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Connect to remote sftp
+    def connect(self):
+        self.logclass.logInfo('Connect to {host} using {conntype}'.format(host=self.host,conntype=self.conntype))
+        if self.conntype in transports:
+            # Remote state may have changed since last connection
+            self.remote.invalidate()
+            t = self.metrics.start()
+            self.conn = self.__openConnection()
+            self.metrics.stop(t,'connect',self.section)
+            if self.conn == False:
+                return False
+
+            # Save current remote path
+            self.pwd = self.conn.pwd
+
+            # Success
+            return True
+        else:
+            # Not supported
+            self.logclass.logError('Unknown conntype',self.lineno())
+            return False
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Open a new connection with the transport of "conntype", returns the connection or False
+    def __openConnection(self):
+        try:
+            return transports[self.conntype](self)
+        except Exception as e:
+            self.logclass.logError('Failed to connect: {c}: {e}'.format(c=e.__class__,e=e),self.lineno())
+            return False
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Path of the private key, relative paths are from "basepath"
+    def getKeyFile(self):
+        if (self.privkey != '') and (self.privkey[0] != '/'):
+            return os.path.join(self.basepath,self.privkey)
+        return self.privkey
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Get a connection for a worker thread from the pool, open a new one if the pool is empty
+    def __getPoolConnection(self):
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            self.logclass.logInfo('Connect worker to {host} using {conntype}'.format(host=self.host,conntype=self.conntype))
+            t = self.metrics.start()
+            conn = self.__openConnection()
+            self.metrics.stop(t,'connect',self.section)
+            return conn
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Return a worker connection back to the pool
+    def __releasePoolConnection(self,conn):
+        if not conn == False:
+            self.pool.put(conn)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Run the jobs as a pipeline of stages connected with bounded queues, so the stages overlap and
+    # memory use doesn't grow with the number of files:
+    #  scan => "jobs" (usually a generator listing/filtering the directory) is run in its own thread
+    #  upload => "func(conn,job)" run by "workers" threads. With one worker the main connection is used,
+    #            otherwise each worker takes its own connection from the pool.
+    #  post => "post(job,result)" run in its own thread with the result of "func" (move file, store state)
+    def __runJobs(self,jobs,func,post=None):
+        workers = max(1,self.workers)
+        todo = queue.Queue(maxsize=workers * self.queueDepth)
+        done = queue.Queue(maxsize=workers * self.queueDepth)
+        stop = object()
+
+        # Scan stage
+        section = self.section
+        def scan():
+            self.logclass.setSection(section)
+            try:
+                for job in jobs:
+                    todo.put(job)
+            except Exception as e:
+                self.logclass.logError('Caught exception: {c}: {e}'.format(c=e.__class__,e=e),self.lineno())
+            finally:
+                for i in range(workers):
+                    todo.put(stop)
+
+        # Upload stage
+        def upload():
+            self.logclass.setSection(section)
+            pooled = workers > 1
+            conn = False
+            while True:
+                job = todo.get()
+                if job is stop:
+                    break
+                try:
+                    if pooled and (conn == False):
+                        conn = self.__getPoolConnection()
+                    if pooled and (conn == False):
+                        # Could not connect, log the file as failed
+                        self.logclass.logError('Upload skipped, no connection : {f}'.format(f=job[1]),self.lineno())
+                        result = False
+                    else:
+                        result = func(conn,job)
+                except Exception as e:
+                    self.logclass.logError('Caught exception: {c}: {e}'.format(c=e.__class__,e=e),self.lineno())
+                    result = False
+                if (not result) and pooled and (not conn == False) and (not self.__isAlive(conn)):
+                    # Connection lost, next job opens a new one
+                    self.logclass.logInfo('Worker connection lost')
+                    self.remote.invalidate(conn)
+                    try:
+                        conn.close()
+                    except Exception as e:
+                        pass
+                    conn = False
+                if post is not None:
+                    done.put((job,result))
+            if pooled:
+                self.__releasePoolConnection(conn)
+
+        # Post processing stage
+        def postprocess():
+            self.logclass.setSection(section)
+            while True:
+                item = done.get()
+                if item is stop:
+                    break
+                try:
+                    post(item[0],item[1])
+                except Exception as e:
+                    self.logclass.logError('Caught exception: {c}: {e}'.format(c=e.__class__,e=e),self.lineno())
+
+        threads = [threading.Thread(target=scan,name='scan')]
+        threads += [threading.Thread(target=upload,name='upload-{n}'.format(n=i)) for i in range(workers)]
+        for th in threads:
+            th.start()
+        if post is not None:
+            poster = threading.Thread(target=postprocess,name='post')
+            poster.start()
+        for th in threads:
+            th.join()
+        if post is not None:
+            done.put(stop)
+            poster.join()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # True if the sftp connection is still usable
+    def __isAlive(self,conn):
+        if hasattr(conn,'isAlive'):
+            return conn.isAlive()
+        try:
+            return conn.sftp_client.get_channel().get_transport().is_active()
+        except Exception as e:
+            return False
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Drop connections which have been closed by remote, they are opened again when needed.
+    # Used by long running processes between runs.
+    def keepAlive(self):
+        if (not self.conn == False) and (not self.__isAlive(self.conn)):
+            self.logclass.logInfo('Remote connection lost')
+            self.remote.invalidate()
+            try:
+                self.conn.close()
+            except Exception as e:
+                pass
+            self.conn = False
+        alive = []
+        while True:
+            try:
+                conn = self.pool.get_nowait()
+            except queue.Empty:
+                break
+            if self.__isAlive(conn):
+                alive.append(conn)
+            else:
+                self.remote.invalidate(conn)
+        for conn in alive:
+            self.pool.put(conn)
+        for name in self.fanout:
+            self.fanout[name].keepAlive()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Disconnect sftp
+    def disconnect(self):
+        if not self.conn == False:
+            if self.conntype in transports:
+                # We have a connection; disconnect
+                self.remote.invalidate(self.conn)
+                self.conn.close()
+                self.conn = False
+                self.logclass.logInfo('Remote disconnected')
+        # Close worker connections
+        while True:
+            try:
+                conn = self.pool.get_nowait()
+            except queue.Empty:
+                break
+            self.remote.invalidate(conn)
+            try:
+                conn.close()
+            except Exception as e:
+                pass
+        # Close asyncio engine (SSH session of all views)
+        if not self.engine == False:
+            self.engine.close()
+            self.engine = False
+        # Disconnect targets (their state database is ours)
+        for name in self.fanout:
+            self.fanout[name].disconnect()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Disconnect sftp and close the local state database
+    def close(self):
+        if self.remote.roundTripsSaved > 0:
+            self.logclass.logInfo('Remote directory cache saved {n} round trips'.format(n=self.remote.roundTripsSaved))
+        self.disconnect()
+        if not self.state == False:
+            self.state.close()
+            self.state = False
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Get current line in code when called
+    def lineno(self):
+        return sys._getframe(1).f_lineno
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Joining path for remote sftp
+    def joinpath(self,p1,p2):
+        if not p1.endswith('/'):
+            p1 += '/'
+        return p1+p2
+
+    # ---------------------------------------------------------------------------------------------------------
+    # A SQLite database can store file timestamps for each section when needed.
+    # This is used for preventing upload of a file which has not changed.
+    # Returns the file modification time as string if the file has changed, else False.
+    # The new timestamp is not stored here, it's stored with "state.setTimestamp" after a succesfull upload.
+    def __checkTimestampFromSQLite(self,section='',sfile=''):
+        # Get file modification time as string
+        try:
+            tsfile = str(os.path.getmtime(sfile))
+        except OSError:
+            # File not found
+            return False
+
+        if self.getState().getTimestamp(section,sfile) != tsfile:
+            # Different
+            return tsfile
+        else:
+            # No change in timestamp
+            return False
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Use metrics "m" for timing
+    def setMetrics(self,m):
+        self.metrics = m
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Use a shared local state database (several transfers of the same customer)
+    def setState(self,state):
+        self.state = state
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Get the local state database, opened once per run
+    def getState(self):
+        if self.state == False:
+            self.state = filestate('{sid}.db'.format(sid=self.sid))
+        return self.state
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Run a "set-" section of settings "s".
+    # When "files" is given only those files (names in "from" directory) are checked instead of
+    # the whole directory.
+    def doSet(self,s,section,files=False):
+        self.section = section
+        self.logclass.setSection(section)
+        # Get type as it tells what kind of transfer is needed
+        sType = s.getString(section,'type','1')
+
+        # Get some basic settings
+        pathFrom = s.getString(section,'from','')
+        pathTo = s.getString(section,'to','')
+
+        # Compile filtering of the set once
+        filters = self.__setFilters(s,section)
+        if filters == False:
+            return
+
+        # Number of parallel uploads (connections) for this set
+        self.setWorkers(s.getInt(section,'workers',s.getInt('sftp','workers',1)))
+
+        # Verification of uploaded files for this set
+        self.setVerify(
+            s.getString(section,'verify',s.getString('sftp','verify','size')),
+            s.getString(section,'hashalg',s.getString('sftp','hashalg','sha256'))
+        )
+
+        # Files of at least "largefile" MB are uploaded with a temporary name and can be resumed
+        self.setLargeFile(s.getInt(section,'largefile',s.getInt('sftp','largefile',0)) * 1048576)
+
+        # How type 2 detects changed files
+        self.setChangeDetect(s.getString(section,'changedetect','sqlite'))
+
+        # Files which only grow get just the new bytes appended (type 2)
+        self.setAppend((sType == '2') and (s.getInt(section,'append',0) == 1))
+
+        # Retry of failed uploads
+        self.setRetry(
+            s.getInt(section,'retrybase',s.getInt('sftp','retrybase',60)),
+            s.getInt(section,'retrymax',s.getInt('sftp','retrymax',21600)),
+            s.getInt(section,'retrylimit',s.getInt('sftp','retrylimit',10)),
+            s.getInt(section,'retryperrun',s.getInt('sftp','retryperrun',100))
+        )
+
+        # Small files are sent as tar bundles
+        self.setBundle(
+            s.getString(section,'bundle',''),
+            s.getInt(section,'bundlemax',1024) * 1024,
+            s.getInt(section,'bundlefiles',1000)
+        )
+
+        # Order of uploads within the set
+        self.setOrder(s.getString(section,'order',''),s.getInt(section,'deadline',0))
+
+        # More targets the files are streamed to at the same time
+        self.__setTargets(s,section,sType,pathTo)
+
+        # Bandwidth cap of the set, and its share of the cap of the customer
+        self.limit = self.limits.child(s.getInt(section,'ratelimit',0) * 1024,s.getInt(section,'weight',1))
+        try:
+            self.__runSet(s,section,sType,pathFrom,pathTo,filters,files)
+        finally:
+            self.__rateReport()
+            self.limit.release()
+            self.limit = self.limits
+            self.logclass.setSection('')
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Targets of a "set-" section: "targets" lists sections, each with the remote path "to" (default "to" of
+    # the set) and the remote settings of [sftp] which it can override (host, port, user, password, key,
+    # conntype). Only for type 1 and type 2 (sqlite); the files are then uploaded whole (no bundles,
+    # append or resume of large files).
+    def __setTargets(self,s,section,sType,pathTo):
+        self.targets = []
+        names = [name.strip() for name in s.getString(section,'targets','').split(',') if name.strip() != '']
+        if len(names) == 0:
+            return
+        if (sType not in ('1','2')) or (self.changeDetect != 'sqlite'):
+            self.logclass.logError('Targets are only used by type 1 and type 2 (sqlite) : {k}'.format(k=section),self.lineno())
+            return
+        for name in names:
+            if not s.sectionExists(name):
+                self.logclass.logError('Unknown target : {t}'.format(t=name),self.lineno())
+                continue
+            tr = self.fanout.get(name)
+            if tr is None:
+                tr = transfer(self.sid,self.logclass,self.basepath)
+                tr.setRemote(
+                    host=s.getString(name,'host',s.getString('sftp','host','')),
+                    port=s.getInt(name,'port',s.getInt('sftp','port',22)),
+                    user=s.getString(name,'user',s.getString('sftp','user','')),
+                    password=s.getString(name,'password',s.getString('sftp','password','')),
+                    privkey=s.getString(name,'key',s.getString('sftp','key','')),
+                    conntype=s.getString(name,'conntype',s.getString('sftp','conntype','sftp'))
+                )
+                tr.setState(self.getState())
+                tr.setMetrics(self.metrics)
+                self.fanout[name] = tr
+            tr.setTuning(self.blockSize,self.window,self.maxPacket,self.maxRequests)
+            tr.section = section
+            self.targets.append((name,tr,s.getString(name,'to',pathTo)))
+        if len(self.targets) > 0:
+            self.setBundle('')
+            self.setAppend(False)
+            self.setLargeFile(0)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Log achieved upload rate of the set being run (and the time it waited on the bandwidth cap)
+    def __rateReport(self):
+        (n,t,r,w) = self.limit.report()
+        if n == 0:
+            return
+        self.metrics.observe('ratelimit',self.section,w)
+        if self.limit.active():
+            self.logclass.logInfo('{k} sent {n:.1f} MB in {t:.1f} s, {r:.2f} MB/s (limit now {l:.2f} MB/s, waited {w:.1f} s)'.format(
+                k=self.section,n=n / 1048576,t=t,r=r / 1048576,l=self.limit.getRate() / 1048576,w=w))
+        else:
+            self.logclass.logInfo('{k} sent {n:.1f} MB in {t:.1f} s, {r:.2f} MB/s'.format(k=self.section,n=n / 1048576,t=t,r=r / 1048576))
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Run set of type "sType", see doSet
+    def __runSet(self,s,section,sType,pathFrom,pathTo,filters,files):
+        # Now do the actual file processing accoring to sType
+        if sType == '1':
+            # Upload all files from single "directory" to sftp remote site "directory". 
+            # After succesfull upload move the file from "directory" to "transfered directory".
+            pathTransfered = s.getString(section,'transfered','')
+            self.doType1(pathFrom,pathTo,pathTransfered,filters=filters,files=files)
+        elif sType == '2':
+            # Transfer all files from single "directory" to remote site "directory".
+            # Use a sqlite database to detect if a file has been changed and dont upload if same timestamp.
+            self.doType2(section,pathFrom,pathTo,filters=filters,files=files)
+        elif sType == '3':
+            # Mirror a directory tree to remote site. Each remote directory is listed once and only
+            # missing or changed (size/modification time) files are uploaded.
+            self.doType3(pathFrom,pathTo,filters=filters)
+        elif sType == '4':
+            # Download files from remote site "directory" (from) to local "directory" (to). The remote
+            # directory is listed once and new or changed files are downloaded, optionally the remote
+            # file is moved to remote "transfered directory" or deleted after the download.
+            self.doType4(
+                section,pathFrom,pathTo,
+                s.getString(section,'remoteafter',''),
+                s.getString(section,'transfered',''),
+                filters=filters
+            )
+        else:
+            self.logclass.logError('Unknown type : {t}'.format(t=sType),self.lineno())
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Filtering of a "set-" section, False (logged) if a regex is not valid
+    def __setFilters(self,s,section):
+        try:
+            return filefilter(
+                s.getString(section,'extfilterinc',''), s.getString(section,'extfilterexc',''),
+                s.getString(section,'globinc',''), s.getString(section,'globexc',''),
+                s.getString(section,'regexinc',''), s.getString(section,'regexexc',''),
+                s.getInt(section,'minsize',0), s.getInt(section,'maxsize',0),
+                s.getInt(section,'minage',0), s.getInt(section,'maxage',0)
+            )
+        except re.error as e:
+            self.logclass.logError('Invalid regex in {k}, set skipped : {e}'.format(k=section,e=e),self.lineno())
+            return False
+
+    # ---------------------------------------------------------------------------------------------------------
+    # True if a "set-" section has files to send, checked without connecting:
+    #  type 1 => any file passing the filters (not waiting for a retry)
+    #  type 2 => any file passing the filters which has changed since its upload (any file with changedetect = remote)
+    # Other types compare with the remote side and are always run.
+    # The local database is only opened when files pass the filters and the directory has changed since
+    # the set last had nothing to send (or a retry is due).
+    def hasPending(self,s,section):
+        sType = s.getString(section,'type','1')
+        if sType not in ('1','2'):
+            return True
+        pathFrom = s.getString(section,'from','')
+        if not os.path.isdir(pathFrom):
+            # Let the run log it
+            return True
+        filters = self.__setFilters(s,section)
+        if filters == False:
+            return False
+        history = (sType == '2') and (s.getString(section,'changedetect','sqlite') != 'remote')
+        files = []
+        for (sfile,st) in self.__scanDir(pathFrom):
+            if filters.checkExclude(sfile,st) and filters.checkInclude(sfile)[0]:
+                files.append((sfile,st.stat() if isinstance(st,os.DirEntry) else st))
+        if len(files) == 0:
+            return False
+
+        # Same files as when there was nothing to send?
+        state = self.getState()
+        sig = '{m}:{n}:{t}:{b}'.format(m=os.stat(pathFrom).st_mtime_ns,n=len(files),
+            t=max(st.st_mtime_ns for (sfile,st) in files),b=sum(st.st_size for (sfile,st) in files))
+        idle = state.getIdle(section)
+        if (idle != False) and (idle[0] == sig) and (time.time() < idle[1]):
+            return False
+
+        state.loadRetries(section)
+        for (sfile,st) in files:
+            if (not history) or self.__checkTimestampFromSQLite(section,os.path.join(pathFrom,sfile)):
+                if self.__retryCheck(section,os.path.join(pathFrom,sfile),st) != 2:
+                    state.clearIdle(section)
+                    return True
+        state.setIdle(section,sig,state.nextRetry(section))
+        return False
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Files of a local directory, yields (filename,stat) where stat is a os.DirEntry or os.stat_result.
+    # When "files" is given only those files are checked instead of listing the directory.
+    def __scanDir(self,pathFrom,files=False,order=''):
+        if order != '':
+            yield from self.__orderFiles(self.__scanDir(pathFrom,files))
+            return
+        if files == False:
+            for entry in os.scandir(pathFrom):
+                if not entry.is_dir():
+                    yield (entry.name,entry)
+        else:
+            for sfile in files:
+                try:
+                    st = os.stat(os.path.join(pathFrom,sfile))
+                except OSError:
+                    # Removed since
+                    continue
+                if not stat.S_ISDIR(st.st_mode):
+                    yield (sfile,st)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Files (filename,stat) of "entries" in the order of the set, the whole directory is read first
+    def __orderFiles(self,entries):
+        files = []
+        for (sfile,st) in entries:
+            try:
+                if isinstance(st,os.DirEntry):
+                    st = st.stat()
+            except OSError:
+                # Removed since
+                continue
+            files.append((sfile,st))
+        if self.order == 'smallest':
+            files.sort(key=lambda f: (f[1].st_size,f[0]))
+        else:
+            # oldest and deadline (same deadline for all files of the set)
+            files.sort(key=lambda f: (f[1].st_mtime,f[0]))
+        if (self.order == 'deadline') and (self.deadline > 0):
+            now = time.time()
+            late = [sfile for (sfile,st) in files if st.st_mtime + self.deadline < now]
+            if len(late) > 0:
+                self.metrics.count('files_late',self.section,len(late))
+                self.logclass.logWarning('{n} files past deadline of {d} s in {k}: {f}'.format(
+                    n=len(late),d=self.deadline,k=self.section,f=', '.join(late[:10]) + (' ..' if len(late) > 10 else '')))
+        return files
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Transfer all files from single "directory" to remote site "directory". 
+    # After succesfull transfer move the file from "directory" to "transfered directory"
+    # "filters" is a filefilter, when not given it's created from extFilterInc/extFilterExc
+    # "files" is a list of filenames to check instead of the whole directory
+    def doType1(self,pathFrom='',pathTo='',pathTransfered='',extFilterInc='',extFilterExc='',filters=False,files=False):
+        if filters == False:
+            filters = filefilter(extFilterInc,extFilterExc)
+        if self.conntype in transports:
+            self.__doType1_sftp(
+                pathFrom, pathTo,
+                self.__chgPath(pathTransfered),             # Check for macros
+                filters, files
+            )
+        else:
+            self.logclass.logError('doType1 conntype not supported yet',self.lineno())
+
+    # ---------------------------------------------------------------------------------------------------------
+    # doType1 with sftp
+    def __doType1_sftp(self,pathFrom='',pathTo='',pathTransfered='',filters=False,files=False):
+        if not os.path.exists(pathFrom):
+            self.logclass.logError('Directory does not exists : {d}'.format(d=pathFrom),self.lineno())
+            return False
+
+        # Create some directories
+        if pathTransfered != '':
+            if not os.path.exists(pathTransfered):
+                self.logclass.logInfo('Creating directory {d}'.format(d=pathTransfered))
+                os.makedirs(pathTransfered)
+                if not os.path.exists(pathTransfered):
+                    self.logclass.logError('Failed to create : {d}'.format(d=pathTransfered),self.lineno())
+                    return False
+
+        # Failed uploads waiting for retry
+        section = self.section
+        state = self.getState()
+        state.loadRetries(section)
+
+        # Go through all files in directory
+        def scan():
+            t = self.metrics.start()
+            active = 0.0
+            retries = []
+            for (sfile,st) in self.__scanDir(pathFrom,files,self.order):
+                # Check filtering (exclude overrides include filtering)
+                b = filters.checkExclude(sfile,st)
+                if not b:
+                    self.logclass.logInfo('File {f} excluded due to Exc filtering'.format(f=sfile))
+                else:
+                    (b,sfile2) = filters.checkInclude(sfile)
+                    if not b:
+                        self.logclass.logInfo('File {f} excluded due to Inc filtering'.format(f=sfile))
+                    else:
+                        r = self.__retryCheck(section,os.path.join(pathFrom,sfile),st)
+                        if r == 0:
+                            # Queue file for upload
+                            active = self.metrics.lap(t,active)
+                            yield (pathFrom,sfile,pathTo,sfile2)
+                            t = self.metrics.start()
+                        elif (r == 1) and (len(retries) < self.retryPerRun):
+                            # Failed before, retried after the other files
+                            retries.append((pathFrom,sfile,pathTo,sfile2))
+            self.metrics.observe('scan',self.section,self.metrics.lap(t,active))
+            for job in retries:
+                yield job
+
+        # Upload queued files
+        def upload(conn,job):
+            (pathFrom,sfile,pathTo,sfile2) = job
+            if len(self.targets) > 0:
+                return self.__uploadFanout_sftp(pathFrom,sfile,pathTo,sfile2,conn)
+            return self.__uploadFile_sftp(pathFrom,sfile,pathTo,sfile2,conn)
+
+        # After succesfull upload move the file to another directory
+        def move(job,result):
+            (pathFrom,sfile,pathTo,sfile2) = job
+            self.__retryResult(section,os.path.join(pathFrom,sfile),result)
+            if result and (pathTransfered != ''):
+                try:
+                    # Move the file to another directory
+                    self.logclass.logInfo('Move file to transfer directory')
+                    shutil.move(os.path.join(pathFrom,sfile),os.path.join(pathTransfered,sfile))
+                except Exception as e:
+                    self.logclass.logError('Failed to move file : {f}'.format(f=sfile),self.lineno())
+
+        if self.bundle != '':
+            # Files are moved once the bundle they are in is uploaded
+            self.__runJobs(*self.__bundleJobs(scan(),upload,move))
+        else:
+            self.__runJobs(scan(),upload,move)
+        self.__retryReport(section)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Transfer all files from single "directory" to remote site "directory". 
+    # "filters" is a filefilter, when not given it's created from extFilterInc/extFilterExc
+    # "files" is a list of filenames to check instead of the whole directory
+    def doType2(self,section='',pathFrom='',pathTo='',extFilterInc='',extFilterExc='',filters=False,files=False):
+        if filters == False:
+            filters = filefilter(extFilterInc,extFilterExc)
+        if self.conntype in transports:
+            self.__doType2_sftp(section,pathFrom,pathTo,filters,files)
+        else:
+            self.logclass.logError('doType2 conntype not supported yet',self.lineno())
+
+    # ---------------------------------------------------------------------------------------------------------
+    # doType2 with sftp
+    def __doType2_sftp(self,section='',pathFrom='',pathTo='',filters=False,files=False):
+        if not os.path.exists(pathFrom):
+            self.logclass.logError('Directory does not exists : {d}'.format(d=pathFrom),self.lineno())
+            return False
+
+        if self.changeDetect == 'remote':
+            # Compare against remote directory instead of local history
+            return self.__doType2Remote_sftp(pathFrom,pathTo,filters,files)
+
+        # Load stored timestamps of section
+        t = self.metrics.start()
+        state = self.getState()
+        state.loadSection(section)
+        self.metrics.stop(t,'sqlite',self.section)
+
+        # Failed uploads waiting for retry
+        state.loadRetries(section)
+
+        # Go through all files in directory
+        def scan():
+            t = self.metrics.start()
+            active = 0.0
+            retries = []
+            for (sfile,st) in self.__scanDir(pathFrom,files,self.order):
+                # Check filtering (exclude overrides include filtering)
+                b = filters.checkExclude(sfile,st)
+                if b:
+                    (b,sfile2) = filters.checkInclude(sfile)
+                    if b:
+                        # Check db regarding file if timestamp has changed
+                        tsfile = self.__checkTimestampFromSQLite(section,os.path.join(pathFrom,sfile))
+                        if tsfile:
+                            r = self.__retryCheck(section,os.path.join(pathFrom,sfile),st)
+                            if r == 0:
+                                # Queue file for upload
+                                active = self.metrics.lap(t,active)
+                                yield (pathFrom,sfile,pathTo,sfile2,tsfile)
+                                t = self.metrics.start()
+                            elif (r == 1) and (len(retries) < self.retryPerRun):
+                                # Failed before, retried after the other files
+                                retries.append((pathFrom,sfile,pathTo,sfile2,tsfile))
+                        #else:
+                        #    self.logclass.logInfo('File {f} timestamp has not changed'.format(f=sfile))
+                    #else:
+                    #    self.logclass.logInfo('File {f} excluded due to Inc filtering'.format(f=sfile))
+                #else:
+                #    self.logclass.logInfo('File {f} excluded due to Exc filtering'.format(f=sfile))
+            self.metrics.observe('scan',self.section,self.metrics.lap(t,active))
+            for job in retries:
+                yield job
+
+        # Upload queued files
+        def upload(conn,job):
+            (pathFrom,sfile,pathTo,sfile2,tsfile) = job
+            if len(self.targets) > 0:
+                return self.__uploadFanout_sftp(pathFrom,sfile,pathTo,sfile2,conn)
+            return self.__uploadFile_sftp(pathFrom,sfile,pathTo,sfile2,conn)
+
+        # Store the new timestamp only after a succesfull upload so a failed upload is retried on next run
+        def store(job,result):
+            (pathFrom,sfile,pathTo,sfile2,tsfile) = job
+            self.__retryResult(section,os.path.join(pathFrom,sfile),result)
+            if result:
+                t = self.metrics.start()
+                state.setTimestamp(section,os.path.join(pathFrom,sfile),tsfile)
+                self.metrics.stop(t,'sqlite',self.section)
+
+        if self.bundle != '':
+            # Timestamps are stored for each file of a bundle once it's uploaded
+            self.__runJobs(*self.__bundleJobs(scan(),upload,store))
+        else:
+            self.__runJobs(scan(),upload,store)
+
+        # Write remaining timestamps
+        t = self.metrics.start()
+        state.flush()
+        self.metrics.stop(t,'sqlite',self.section)
+        self.__retryReport(section)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # doType2 comparing size and modification time against the remote directory, listed once.
+    # Needs no local history, and files changed or removed on remote are uploaded again.
+    def __doType2Remote_sftp(self,pathFrom='',pathTo='',filters=False,files=False):
+        if self.conn == False:
+            # Connect to sftp, needed for listing remote directory
+            if not self.connect():
+                return False
+        if (len(pathTo) > 1) and (pathTo[-1] == '/'):
+            # remove trailing delimiter
+            pathTo = pathTo[:-1]
+
+        t = self.metrics.start()
+        try:
+            remote = self.__listRemote(self.conn,pathTo)
+            if remote is None:
+                remote = {}
+        except Exception as e:
+            self.remote.invalidate(self.conn)
+            self.logclass.logError('Caught exception: {c}: {e}'.format(c=e.__class__,e=e),self.lineno())
+            return False
+        self.metrics.stop(t,'remote_dir',self.section)
+
+        # Go through all files in directory
+        def scan():
+            t = self.metrics.start()
+            active = 0.0
+            for (sfile,st) in self.__scanDir(pathFrom,files,self.order):
+                # Check filtering (exclude overrides include filtering)
+                if filters.checkExclude(sfile,st):
+                    (b,sfile2) = filters.checkInclude(sfile)
+                    if b:
+                        if isinstance(st,os.DirEntry):
+                            st = st.stat()
+                        r = remote.get(sfile2)
+                        if (r is None) or (r.st_size != st.st_size) or (int(r.st_mtime) != int(st.st_mtime)):
+                            # Queue file for upload
+                            active = self.metrics.lap(t,active)
+                            yield (pathFrom,sfile,pathTo,sfile2,st)
+                            t = self.metrics.start()
+            self.metrics.observe('scan',self.section,self.metrics.lap(t,active))
+
+        # Upload queued files, keep modification time so the file is seen as same on next run
+        def upload(conn,job):
+            (pathFrom,sfile,pathTo,sfile2,st) = job
+            if self.__uploadFile_sftp(pathFrom,sfile,pathTo,sfile2,conn):
+                self.__setRemoteTime(conn,self.joinpath(pathTo,sfile2),st)
+                return True
+            return False
+        self.__runJobs(scan(),upload)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Check retry state of local file "path" ("st" its os.stat result or os.DirEntry):
+    #  0 => not failed before (or changed since), upload
+    #  1 => failed before and due for retry
+    #  2 => failed before and waiting, or quarantined
+    def __retryCheck(self,section,path,st):
+        r = self.getState().getRetry(section,path)
+        if r == False:
+            return 0
+        if isinstance(st,os.DirEntry):
+            st = st.stat()
+        if str(st.st_mtime) != r[3]:
+            # Changed since last failure, start again
+            self.getState().clearRetry(section,path)
+            return 0
+        if r[4] or (r[2] > time.time()):
+            return 2
+        return 1
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Keep retry state of local file "path" after its upload: removed after success, after a failure the
+    # next retry is set (or the file is quarantined) with the reason of the failure
+    def __retryResult(self,section,path,result):
+        state = self.getState()
+        reason = self.failures.pop(path,'Upload failed')
+        r = state.getRetry(section,path)
+        if result:
+            if r != False:
+                state.clearRetry(section,path)
+            return
+        try:
+            mtime = str(os.path.getmtime(path))
+        except OSError:
+            # Removed since
+            return
+        attempts = 1 if r == False else r[0] + 1
+        if attempts >= self.retryLimit:
+            self.logclass.logError('Quarantined {f} after {n} failed uploads: {r}'.format(f=path,n=attempts,r=reason),self.lineno())
+            state.setRetry(section,path,attempts,reason,0,mtime,True)
+        else:
+            wait = min(self.retryMax,self.retryBase * 2 ** (attempts - 1))
+            self.logclass.logInfo('Retry {f} in {w} s (failed {n} times): {r}'.format(f=path,w=wait,n=attempts,r=reason))
+            state.setRetry(section,path,attempts,reason,time.time() + wait,mtime,False)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Report quarantined files of a set, failed uploads of files removed since are forgotten
+    def __retryReport(self,section):
+        n = self.getState().pruneRetries(section)
+        if n > 0:
+            self.logclass.logInfo('Forgot {n} failed uploads of removed files in {k}'.format(n=n,k=section))
+        quarantined = self.getState().getQuarantined(section)
+        self.metrics.count('files_quarantined',self.section,len(quarantined))
+        if len(quarantined) > 0:
+            self.logclass.logWarning('{n} quarantined files in {k} (not uploaded until changed): {f}'.format(
+                n=len(quarantined),k=section,f=', '.join(quarantined[:10]) + (' ..' if len(quarantined) > 10 else '')))
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Group small files of "jobs" (pathFrom,sfile,pathTo,sfile2,...) into bundles.
+    # Returns (jobs,func,post) for __runJobs: a bundle is uploaded as one tar file and "post" is called for
+    # each file of it with the result of the bundle. Files of at least "bundleMax" bytes are passed to
+    # "func" one by one.
+    def __bundleJobs(self,jobs,func,post):
+        def group():
+            small = []
+            for job in jobs:
+                try:
+                    size = os.path.getsize(os.path.join(job[0],job[1]))
+                except OSError:
+                    size = 0
+                if size >= self.bundleMax:
+                    yield ('file',job)
+                    continue
+                small.append(job)
+                if len(small) >= self.bundleFiles:
+                    yield ('bundle',self.__bundleName(),small)
+                    small = []
+            if len(small) == 1:
+                yield ('file',small[0])
+            elif len(small) > 1:
+                yield ('bundle',self.__bundleName(),small)
+
+        def upload(conn,job):
+            if job[0] == 'file':
+                return func(conn,job[1])
+            return self.__uploadBundle_sftp(job[1],job[2],conn)
+
+        def postprocess(job,result):
+            if job[0] == 'file':
+                post(job[1],result)
+            else:
+                for j in job[2]:
+                    post(j,result)
+
+        return (group(),upload,postprocess)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Name of next bundle: <sid>_<set>_<run timestamp>_<pid>-<random>_<number>.tar[.gz]
+    # The pid and random part keep names of other transfers and runs (same second) apart, as the
+    # upload replaces a remote file of the same name.
+    def __bundleName(self):
+        self.bundleSeq += 1
+        return '{sid}_{k}_{ts}_{p}-{u}_{n:04d}.{b}'.format(sid=self.sid,k=self.section,ts=self.ts.strftime('%Y%m%d%H%M%S'),
+            p=os.getpid(),u=uuid.uuid4().hex[:8],n=self.bundleSeq,b=self.bundle)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # List remote directory once, returns {filename: SFTPAttributes}. None if it can't be listed.
+    def __listRemote(self,conn,rdir):
+        remote = {}
+        try:
+            for attr in conn.listdir_attr(rdir):
+                remote[attr.filename] = attr
+        except IOError:
+            # Missing or unreadable, forget it so it's created again
+            self.remote.invalidate(conn,rdir)
+            return None
+        self.remote.addDir(rdir)
+        return remote
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Mirror local directory tree "pathFrom" to remote "pathTo".
+    # "filters" is a filefilter, when not given it's created from extFilterInc/extFilterExc
+    def doType3(self,pathFrom='',pathTo='',extFilterInc='',extFilterExc='',filters=False):
+        if filters == False:
+            filters = filefilter(extFilterInc,extFilterExc)
+        if self.conntype in transports:
+            self.__doType3_sftp(pathFrom,pathTo,filters)
+        else:
+            self.logclass.logError('doType3 conntype not supported yet',self.lineno())
+
+    # ---------------------------------------------------------------------------------------------------------
+    # doType3 with sftp
+    def __doType3_sftp(self,pathFrom='',pathTo='',filters=False):
+        if not os.path.exists(pathFrom):
+            self.logclass.logError('Directory does not exists : {d}'.format(d=pathFrom),self.lineno())
+            return False
+        if self.conn == False:
+            # Connect to sftp, needed for listing remote directories
+            if not self.connect():
+                return False
+        if (len(pathTo) > 1) and (pathTo[-1] == '/'):
+            # remove trailing delimiter
+            pathTo = pathTo[:-1]
+
+        # Compare local and remote trees
+        t = self.metrics.start()
+        jobs = []
+        mkdirs = []
+        try:
+            self.__syncDir(pathFrom,pathTo,filters,jobs,mkdirs,True)
+        except Exception as e:
+            self.remote.invalidate(self.conn)
+            self.logclass.logError('Caught exception: {c}: {e}'.format(c=e.__class__,e=e),self.lineno())
+            return False
+        self.metrics.stop(t,'scan',self.section)
+
+        # Create missing remote directories, parents are listed before their subdirectories
+        t = self.metrics.start()
+        failed = []
+        for d in mkdirs:
+            try:
+                self.logclass.logInfo('Create remote directory : {p}'.format(p=d))
+                if d == pathTo:
+                    self.conn.makedirs(d)
+                else:
+                    self.conn.mkdir(d)
+                self.remote.addDir(d)
+            except Exception as e:
+                self.logclass.logError('Failed to create remote folder(s) : {p}'.format(p=d),self.lineno())
+                failed.append(d)
+        self.metrics.stop(t,'remote_dir',self.section)
+        if len(failed) > 0:
+            # Skip files of directories not created
+            jobs = [job for job in jobs if not any((job[2] == d) or job[2].startswith(d + '/') for d in failed)]
+
+        # Upload missing and changed files, keep modification time so the file is seen as same on next run
+        def upload(conn,job):
+            (ldir,sfile,rdir,sfile2,st) = job
+            if self.__uploadFile_sftp(ldir,sfile,rdir,sfile2,conn):
+                self.__setRemoteTime(conn,self.joinpath(rdir,sfile2),st)
+                return True
+            return False
+        self.__runJobs(jobs,upload)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Download all files from remote "directory" (pathFrom) to local "directory" (pathTo).
+    # A downloaded file is not downloaded again until its size or modification time changes on remote.
+    # "after" tells what's done with the remote file after a succesfull download:
+    #  '' => nothing, move => moved to remote "pathTransfered", delete => deleted
+    # "filters" is a filefilter matched against remote names, when not given it's created from extFilterInc/extFilterExc
+    def doType4(self,section='',pathFrom='',pathTo='',after='',pathTransfered='',extFilterInc='',extFilterExc='',filters=False):
+        if filters == False:
+            filters = filefilter(extFilterInc,extFilterExc)
+        if after not in ('','move','delete'):
+            self.logclass.logError('Unknown remoteafter : {a}'.format(a=after),self.lineno())
+            return False
+        if (after == 'move') and (pathTransfered == ''):
+            self.logclass.logError('No transfered directory to move to',self.lineno())
+            return False
+        if self.conntype in transports:
+            self.__doType4_sftp(section,pathFrom,pathTo,after,self.__chgPath(pathTransfered),filters)
+        else:
+            self.logclass.logError('doType4 conntype not supported yet',self.lineno())
+
+    # ---------------------------------------------------------------------------------------------------------
+    # doType4 with sftp
+    def __doType4_sftp(self,section='',pathFrom='',pathTo='',after='',pathTransfered='',filters=False):
+        if not os.path.exists(pathTo):
+            self.logclass.logInfo('Creating directory {d}'.format(d=pathTo))
+            os.makedirs(pathTo)
+            if not os.path.exists(pathTo):
+                self.logclass.logError('Failed to create : {d}'.format(d=pathTo),self.lineno())
+                return False
+        if self.conn == False:
+            # Connect to sftp, needed for listing remote directory
+            if not self.connect():
+                return False
+        if (len(pathFrom) > 1) and (pathFrom[-1] == '/'):
+            # remove trailing delimiter
+            pathFrom = pathFrom[:-1]
+
+        # List remote directory once
+        t = self.metrics.start()
+        try:
+            remote = self.__listRemote(self.conn,pathFrom)
+            if remote is None:
+                remote = {}
+            if (after == 'move') and (not self.conn.exists(pathTransfered)):
+                self.logclass.logInfo('Create remote directory : {p}'.format(p=pathTransfered))
+                self.conn.makedirs(pathTransfered)
+        except Exception as e:
+            self.remote.invalidate(self.conn)
+            self.logclass.logError('Caught exception: {c}: {e}'.format(c=e.__class__,e=e),self.lineno())
+            return False
+        self.metrics.stop(t,'remote_dir',self.section)
+
+        # Load size/modification time of files already downloaded
+        t = self.metrics.start()
+        state = self.getState()
+        state.loadSection(section)
+        self.metrics.stop(t,'sqlite',self.section)
+
+        # Go through remote files
+        def scan():
+            t = self.metrics.start()
+            active = 0.0
+            for sfile in sorted(remote):
+                attr = remote[sfile]
+                if stat.S_ISDIR(attr.st_mode or 0):
+                    continue
+                # Check filtering (exclude overrides include filtering)
+                if filters.checkExclude(sfile,attr):
+                    (b,sfile2) = filters.checkInclude(sfile)
+                    if b:
+                        sig = '{s}:{m}'.format(s=attr.st_size,m=int(attr.st_mtime))
+                        if state.getTimestamp(section,self.joinpath(pathFrom,sfile)) != sig:
+                            # Queue file for download
+                            active = self.metrics.lap(t,active)
+                            yield (pathFrom,sfile,pathTo,sfile2,attr,sig)
+                            t = self.metrics.start()
+            self.metrics.observe('scan',self.section,self.metrics.lap(t,active))
+
+        # Download queued files, then move or delete remote file
+        def download(conn,job):
+            (pathFrom,sfile,pathTo,sfile2,attr,sig) = job
+            if not self.__downloadFile_sftp(pathFrom,sfile,pathTo,sfile2,attr,conn):
+                return False
+            if conn == False:
+                conn = self.conn
+            remotefile = self.joinpath(pathFrom,sfile)
+            try:
+                if after == 'move':
+                    self.logclass.logInfo('Move remote file to transfer directory')
+                    self.__renameRemote(conn,remotefile,self.joinpath(pathTransfered,sfile))
+                elif after == 'delete':
+                    self.logclass.logInfo('Delete remote file')
+                    conn.remove(remotefile)
+            except Exception as e:
+                self.logclass.logError('Failed to {a} remote file : {f}'.format(a=after,f=remotefile),self.lineno())
+            return True
+
+        # Store size/modification time only after a succesfull download so a failed download is retried on next run
+        def store(job,result):
+            (pathFrom,sfile,pathTo,sfile2,attr,sig) = job
+            if result:
+                t = self.metrics.start()
+                state.setTimestamp(section,self.joinpath(pathFrom,sfile),sig)
+                self.metrics.stop(t,'sqlite',self.section)
+
+        self.__runJobs(scan(),download,store)
+
+        # Write remaining states
+        t = self.metrics.start()
+        state.flush()
+        self.metrics.stop(t,'sqlite',self.section)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Compare local directory "ldir" with remote directory "rdir" (and their subdirectories).
+    # Files to upload are added into "jobs" and remote directories to create into "mkdirs".
+    # "exists" is False when the remote directory is known to be missing, so it's not listed.
+    def __syncDir(self,ldir,rdir,filters,jobs,mkdirs,exists):
+        remote = {}
+        if exists:
+            remote = self.__listRemote(self.conn,rdir)
+            exists = (remote is not None)
+            if not exists:
+                remote = {}
+        if not exists:
+            mkdirs.append(rdir)
+
+        subdirs = []
+        with os.scandir(ldir) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry)
+                    continue
+                # Check filtering (exclude overrides include filtering)
+                if not filters.checkExclude(entry.name,entry):
+                    continue
+                (b,sfile2) = filters.checkInclude(entry.name)
+                if not b:
+                    continue
+                st = entry.stat()
+                r = remote.get(sfile2)
+                if (r is None) or (r.st_size != st.st_size) or (int(r.st_mtime) != int(st.st_mtime)):
+                    jobs.append((ldir,entry.name,rdir,sfile2,st))
+
+        for entry in sorted(subdirs,key=lambda e: e.name):
+            self.__syncDir(entry.path,self.joinpath(rdir,entry.name),filters,jobs,mkdirs,exists and (entry.name in remote))
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Set access/modification time of remote file from local stat "st"
+    def __setRemoteTime(self,conn,remotefile,st):
+        if conn == False:
+            conn = self.conn
+        try:
+            conn.sftp_client.utime(remotefile,(st.st_atime,st.st_mtime))
+            return True
+        except Exception as e:
+            self.logclass.logError('Failed to set time of remote file : {f}'.format(f=remotefile),self.lineno())
+            return False
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Change remote directory of "conn" to "pathTo", create it if needed.
+    # Known directories and the current directory of each connection are kept in "self.remote" so
+    # the checks are done once per run.
+    def __cwdRemote(self,conn,pathTo):
+        # The remote pwd check is always saved
+        self.remote.saved(1)
+        if self.remote.getPwd(conn) == pathTo:
+            # Already there
+            return True
+        try:
+            if self.remote.hasDir(pathTo):
+                # Known to exist (saved exists)
+                self.remote.saved(1)
+            else:
+                if not conn.exists(pathTo):
+                    self.logclass.logInfo('Create remote directory : {p}'.format(p=pathTo))
+                    try:
+                        conn.makedirs(pathTo)
+                    except IOError:
+                        # Another worker may have created it at the same time
+                        if not conn.exists(pathTo):
+                            raise
+                self.remote.addDir(pathTo)
+            # Next lines is actually not needed as sftp should upload to whatever directory the upload points to.
+            # For some reason got an error with a server which failed to upload the file if the current location
+            # was not the actual upload folder; too strict security? Well, this fixed it.
+            conn.cwd(pathTo)
+            pwd = conn.pwd
+            if pwd != pathTo:
+                self.remote.invalidate(conn,pathTo)
+                self.logclass.logError('Failed to cwd to : {p}'.format(p=pathTo),self.lineno())
+                return False
+            self.remote.setPwd(conn,pwd)
+            return True
+        except Exception as e:
+            self.remote.invalidate(conn,pathTo)
+            self.logclass.logError('Failed to create remote folder(s) : {p}'.format(p=pathTo),self.lineno())
+            return False
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Upload local file to remote file according to verification level.
+    # Returns dict with:
+    #  size => local bytes sent
+    #  rsize => remote size (-1 if not known)
+    #  hash => local hash ('' if not calculated)
+    #  rhash => remote hash ('' if not supported by server)
+    #  sent => bytes actually sent (less than size when appended)
+    #  append => (size,fingerprint) to store after a verified upload in append mode
+    def __putFile(self,conn,localfile,remotefile):
+        st = os.stat(localfile)
+        if self.append:
+            result = self.__putAppend(conn,localfile,remotefile,st)
+            if result != False:
+                return result
+        result = self.__putWhole(conn,localfile,remotefile,st)
+        if self.append:
+            with open(localfile,'rb') as lf:
+                result['append'] = (st.st_size,self.__fingerprint(lf,st.st_size))
+        return result
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Upload whole local file, see __putFile
+    def __putWhole(self,conn,localfile,remotefile,st):
+        result = {'size': -1, 'rsize': -1, 'hash': '', 'rhash': ''}
+        if (self.largeFile > 0) and (st.st_size >= self.largeFile):
+            # Large file, upload with temporary name and resume support
+            return self.__putLargeFile(conn,localfile,remotefile,st)
+        if (self.verify == 'hash') or self.limit.active():
+            # Stream the file ourselves so the hash is calculated (and the bandwidth cap applied) during upload
+            h = hashlib.new(self.hashalg) if self.verify == 'hash' else None
+            size = st.st_size
+            with open(localfile,'rb') as lf:
+                with conn.open(remotefile,'wb') as rf:
+                    self.__sendFile(lf,rf,0,size,h)
+                    if h is not None:
+                        try:
+                            # Ask the server for the hash ("check-file" extension)
+                            result['rhash'] = rf.check(self.hashalg).hex()
+                        except IOError:
+                            # Not supported, fall back to size from the open handle
+                            if not self.hashUnsupported:
+                                self.hashUnsupported = True
+                                self.logclass.logWarning('Remote does not support {a} check, verifying size only'.format(a=self.hashalg))
+                    if (self.verify != 'none') and (result['rhash'] == ''):
+                        result['rsize'] = rf.stat().st_size
+            result['size'] = size
+            if h is not None:
+                result['hash'] = h.hexdigest()
+        elif self.verify == 'none':
+            conn.put(localfile,remotefile,confirm=False)
+            self.limit.take(st.st_size)
+        else:
+            # The attributes returned by put come from the stat paramiko does to confirm the upload
+            result['size'] = st.st_size
+            attr = conn.put(localfile,remotefile)
+            result['rsize'] = attr.st_size
+            self.limit.take(st.st_size)
+        result['sent'] = st.st_size
+        return result
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Fingerprint of the first "size" bytes of open file "f": hash of the size and of blocks at the
+    # start, middle and end. Reads at most three blocks, so it's cheap for files of any size.
+    def __fingerprint(self,f,size):
+        h = hashlib.sha256(str(size).encode())
+        for offset in sorted(set([0,max(0,size // 2 - self.fingerprintBlock // 2),max(0,size - self.fingerprintBlock)])):
+            f.seek(offset)
+            h.update(f.read(min(self.fingerprintBlock,size - offset)))
+        return h.hexdigest()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Append the new bytes of a file which has only grown since its last upload.
+    # Returns the result as __putFile, or False when the file can't be appended (not uploaded before,
+    # not grown, start of file changed or remote file not of the uploaded size); it's then uploaded whole.
+    def __putAppend(self,conn,localfile,remotefile,st):
+        state = self.getState()
+        prev = state.getAppend(localfile,remotefile)
+        if (prev == False) or (st.st_size <= prev[0]):
+            return False
+        offset = prev[0]
+        size = st.st_size       # bytes added while uploading are left for next run
+        with open(localfile,'rb') as lf:
+            if self.__fingerprint(lf,offset) != prev[1]:
+                self.logclass.logInfo('Start of {f} has changed, uploading whole file'.format(f=localfile))
+                return False
+            try:
+                rsize = conn.stat(remotefile).st_size
+            except IOError:
+                rsize = -1
+            if rsize != offset:
+                self.logclass.logInfo('Remote {f} is not as uploaded, uploading whole file'.format(f=remotefile))
+                return False
+
+            self.logclass.logInfo('Append {n} bytes to {f}'.format(n=size - offset,f=remotefile))
+            result = {'size': size, 'rsize': -1, 'hash': '', 'rhash': '', 'sent': size - offset}
+            h = hashlib.new(self.hashalg) if self.verify == 'hash' else None
+            if h is not None:
+                # Hash the part already uploaded (local read only)
+                lf.seek(0)
+                left = offset
+                while left > 0:
+                    data = lf.read(min(self.blockSize,left))
+                    if not data:
+                        break
+                    h.update(data)
+                    left -= len(data)
+            with conn.open(remotefile,'r+b') as rf:
+                self.__sendFile(lf,rf,offset,size,h)
+                if h is not None:
+                    result['hash'] = h.hexdigest()
+                    try:
+                        result['rhash'] = rf.check(self.hashalg).hex()
+                    except IOError:
+                        pass
+                if result['rhash'] == '':
+                    result['rsize'] = rf.stat().st_size
+            result['append'] = (size,self.__fingerprint(lf,size))
+        return result
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Upload a large file to a temporary remote name "<remotefile>.part". Progress is stored in the local
+    # state database, so after a failure the next run continues from the size of the remote temporary file.
+    # After the upload is verified the temporary file is renamed to "remotefile".
+    def __putLargeFile(self,conn,localfile,remotefile,st):
+        result = {'size': st.st_size, 'rsize': -1, 'hash': '', 'rhash': ''}
+        state = self.getState()
+        tmpfile = remotefile + '.part'
+        mtime = str(st.st_mtime)
+
+        # Can we resume a previous upload?
+        offset = 0
+        prev = state.getUpload(localfile,remotefile)
+        if (prev != False) and (prev[0] == st.st_size) and (prev[1] == mtime):
+            try:
+                offset = min(conn.stat(tmpfile).st_size,st.st_size)
+            except IOError:
+                offset = 0
+            if offset > 0:
+                self.logclass.logInfo('Resume upload of {f} at {o} bytes'.format(f=localfile,o=offset))
+        state.setUpload(localfile,remotefile,st.st_size,mtime,offset)
+
+        h = hashlib.new(self.hashalg) if self.verify == 'hash' else None
+        # Store progress every "largeChunk" bytes
+        progress = {'saved': offset}
+        def saveProgress(rf,done):
+            if done - progress['saved'] >= self.largeChunk:
+                rf.flush()
+                state.setUpload(localfile,remotefile,st.st_size,mtime,done)
+                progress['saved'] = done
+
+        t = time.perf_counter()
+        with open(localfile,'rb') as lf:
+            if (h is not None) and (offset > 0):
+                # Hash the part already uploaded (local read only)
+                left = offset
+                while left > 0:
+                    data = lf.read(min(self.blockSize,left))
+                    if not data:
+                        break
+                    h.update(data)
+                    left -= len(data)
+            with conn.open(tmpfile,'r+b' if offset > 0 else 'wb') as rf:
+                self.__sendFile(lf,rf,offset,st.st_size,h,saveProgress)
+                if h is not None:
+                    result['hash'] = h.hexdigest()
+                    try:
+                        result['rhash'] = rf.check(self.hashalg).hex()
+                    except IOError:
+                        pass
+                if result['rhash'] == '':
+                    result['rsize'] = rf.stat().st_size
+        t = time.perf_counter() - t
+        result['sent'] = st.st_size - offset
+        self.logclass.logInfo('Sent {n:.1f} MB of {f} in {t:.1f} s, {r:.2f} MB/s'.format(
+            n=(st.st_size - offset) / 1048576,f=localfile,t=t,r=(st.st_size - offset) / 1048576 / max(t,0.001)))
+
+        if not self.__verifyUpload(result):
+            # Start from scratch next time
+            state.clearUpload(localfile,remotefile)
+            return result
+
+        # Rename to final name
+        self.__renameRemote(conn,tmpfile,remotefile)
+        state.clearUpload(localfile,remotefile)
+        return result
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Rename remote "tmpfile" to "remotefile", replacing an existing file
+    def __renameRemote(self,conn,tmpfile,remotefile):
+        try:
+            conn.sftp_client.posix_rename(tmpfile,remotefile)
+        except IOError:
+            if conn.exists(remotefile):
+                conn.remove(remotefile)
+            conn.rename(tmpfile,remotefile)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Send bytes "offset" up to "size" of open local file "lf" to the same position of open remote file "rf".
+    # The local file is read in "blockSize" blocks and sent as write requests, pipelined with at most
+    # "maxRequests" requests waiting for an answer, each block waits for the bandwidth cap of the set.
+    # "h" (hash) is updated with the data sent when given, "progress(rf,done)" is called after each block when given.
+    def __sendFile(self,lf,rf,offset,size,h=None,progress=None):
+        rf.seek(offset)
+        rf.set_pipelined(True)
+        if hasattr(rf,'MAX_REQUEST_SIZE'):
+            # paramiko splits writes into requests of this size
+            rf.MAX_REQUEST_SIZE = self.blockSize
+        pos = offset
+        for data in self.__readBlocks(lf,offset,size):
+            self.limit.take(len(data))
+            rf.write(data)
+            if h is not None:
+                h.update(data)
+            pos += len(data)
+            self.__boundRequests(rf)
+            if progress is not None:
+                progress(rf,pos)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Blocks of "blockSize" bytes from "offset" up to "size" of open local file "lf", read into one buffer.
+    # Raises IOError when the file is shorter than "size" (truncated while uploading), the upload fails.
+    def __readBlocks(self,lf,offset,size):
+        buf = bytearray(self.blockSize)
+        view = memoryview(buf)
+        lf.seek(offset)
+        pos = offset
+        while pos < size:
+            n = min(self.blockSize,size - pos)
+            got = lf.readinto(view[:n]) or 0
+            if got < n:
+                raise IOError('File shrunk during upload: {f} ({n} of {s} bytes)'.format(f=lf.name,n=pos + got,s=size))
+            # Copy, the writer may keep the data after write returns
+            yield bytes(view[:n])
+            pos += n
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Wait for answers of pipelined writes of paramiko file "rf" until at most "maxRequests" are waiting.
+    # paramiko itself only reads answers when more than 100 are waiting and some have arrived.
+    # This needs internals of paramiko (the pending requests of the file), when a version doesn't have
+    # them the writes are left to paramiko's own pipelining (set_pipelined).
+    def __boundRequests(self,rf):
+        if not self.__canBoundRequests(rf):
+            return
+        from paramiko.sftp import CMD_STATUS
+        reqs = rf._reqs
+        rf.flush()
+        while len(reqs) > self.maxRequests:
+            t, msg = rf.sftp._read_response(reqs.popleft())
+            if t != CMD_STATUS:
+                raise IOError('Expected status of write')
+
+    # ---------------------------------------------------------------------------------------------------------
+    # True if the pending write requests of "rf" can be bounded, checked once for paramiko files
+    def __canBoundRequests(self,rf):
+        if not hasattr(rf,'sftp'):
+            # Not a paramiko file, asyncfile and localfile bound their own writes
+            return False
+        if self.boundRequests is None:
+            try:
+                from paramiko.sftp import CMD_STATUS
+                self.boundRequests = isinstance(getattr(rf,'_reqs',None),collections.deque) and callable(getattr(rf.sftp,'_read_response',None))
+            except ImportError:
+                self.boundRequests = False
+            if not self.boundRequests:
+                self.logclass.logWarning('paramiko has no pending requests of a file, maxrequests is not used')
+        return self.boundRequests
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Check result of __putFile, True if upload is ok
+    def __verifyUpload(self,result):
+        if self.verify == 'none':
+            return True
+        if result['rhash'] != '':
+            return result['rhash'] == result['hash']
+        return result['size'] == result['rsize']
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Upload files of "jobs" (pathFrom,sfile,pathTo,sfile2,...) as tar bundle "name" to remote "pathTo".
+    # The files are read into the tar stream while it's uploaded as "<name>.part", which is renamed
+    # when the upload is verified. Each file is logged as its own upload (to "<bundle>:<sfile2>").
+    # "conn" is a worker connection from the pool, or False to use the main connection
+    def __uploadBundle_sftp(self,name,jobs,conn=False):
+        if conn == False:
+            if self.conn == False:
+                # Connect to sftp
+                if not self.connect():
+                    return False
+            conn = self.conn
+        fileids = []
+        sizes = []
+
+        pathTo = jobs[0][2]
+        if pathTo[-1] == '/':
+            # remove trailing delimiter
+            pathTo = pathTo[:-1]
+
+        try:
+            t = self.metrics.start()
+            b = self.__cwdRemote(conn,pathTo)
+            self.metrics.stop(t,'remote_dir',self.section)
+            if not b:
+                self.__bundleFailed(jobs,'Remote directory {p}'.format(p=pathTo))
+                self.metrics.count('files_failed',self.section,len(jobs))
+                return False
+
+            remotefile = self.joinpath(pathTo,name)
+            tmpfile = remotefile + '.part'
+            self.logclass.logInfo('Upload {n} files to {pathTo} as {f}'.format(n=len(jobs),pathTo=pathTo,f=name))
+
+            # Log a start of upload of each file
+            for job in jobs:
+                fileids.append(self.logclass.logFileCreate(
+                    os.path.join(job[0],job[1]),
+                    '[{username}@{hostname}] {r}:{f}'.format(username=self.username,hostname=self.host,r=remotefile,f=job[3])
+                ))
+
+            # Upload bundle
+            t = self.metrics.start()
+            result = {'size': -1, 'rsize': -1, 'hash': '', 'rhash': ''}
+            h = hashlib.new(self.hashalg) if self.verify == 'hash' else None
+            with conn.open(tmpfile,'wb') as rf:
+                rf.set_pipelined(True)
+                w = streamwriter(rf,h,self.__boundRequests,self.limit)
+                with tarfile.open(fileobj=w,mode='w|gz' if self.bundle == 'tar.gz' else 'w|',bufsize=self.blockSize) as tar:
+                    for job in jobs:
+                        tar.add(os.path.join(job[0],job[1]),arcname=job[3],recursive=False)
+                        sizes.append(tar.members[-1].size)
+                result['size'] = w.size
+                if h is not None:
+                    result['hash'] = h.hexdigest()
+                    try:
+                        result['rhash'] = rf.check(self.hashalg).hex()
+                    except IOError:
+                        pass
+                if (self.verify != 'none') and (result['rhash'] == ''):
+                    result['rsize'] = rf.stat().st_size
+            self.metrics.stop(t,'put',self.section)
+            # Log a check of upload
+            for fileid in fileids:
+                self.logclass.logFileCheck(fileid)
+
+            # Check remote the bundle is actually there
+            t = self.metrics.start()
+            b = self.__verifyUpload(result)
+            self.metrics.stop(t,'verify',self.section)
+            if not b:
+                self.logclass.logError('Upload failed',self.lineno())
+                for fileid in fileids:
+                    self.logclass.logFileFail(fileid)
+                self.__bundleFailed(jobs,'Verification of bundle failed')
+                self.metrics.count('files_failed',self.section,len(jobs))
+                return False
+            self.__renameRemote(conn,tmpfile,remotefile)
+
+            # Log a success of upload
+            for (fileid,size) in zip(fileids,sizes):
+                self.logclass.logFilePass(fileid,size)
+            self.metrics.count('files_uploaded',self.section,len(jobs))
+            self.metrics.count('bytes_uploaded',self.section,result['size'])
+            return True
+        except Exception as e:
+            # Upload failed
+            self.metrics.count('files_failed',self.section,len(jobs))
+            self.remote.invalidate(conn,pathTo)
+            self.logclass.logError('Caught exception: {c}: {e}'.format(c=e.__class__,e=e),self.lineno())
+            for fileid in fileids:
+                self.logclass.logFileFail(fileid)
+            self.__bundleFailed(jobs,'{c}: {e}'.format(c=e.__class__.__name__,e=e))
+            return False
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Keep failure "reason" for each file of a bundle
+    def __bundleFailed(self,jobs,reason):
+        for job in jobs:
+            self.failures[os.path.join(job[0],job[1])] = reason
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Download "sfile" with sftp from remote "pathFrom" to local "pathTo" (as "sfile2"). "attr" are the remote
+    # attributes from the listing. The file is downloaded as "<sfile2>.part" and renamed when its size is right.
+    # "conn" is a worker connection from the pool, or False to use the main connection
+    def __downloadFile_sftp(self,pathFrom,sfile1,pathTo,sfile2,attr,conn=False):
+        if conn == False:
+            if self.conn == False:
+                # Connect to sftp
+                if not self.connect():
+                    return False
+            conn = self.conn
+        fileid = 0
+        remotefile = self.joinpath(pathFrom,sfile1)
+        localfile = os.path.join(pathTo,sfile2)
+        tmpfile = localfile + '.part'
+
+        try:
+            # download file
+            if sfile1 != sfile2:
+                # .. and renamed
+                self.logclass.logInfo('Download {f1} from {pathFrom} as {f2}'.format(f1=sfile1,pathFrom=pathFrom,f2=sfile2))
+            else:
+                self.logclass.logInfo('Download {f1} from {pathFrom}'.format(f1=sfile1,pathFrom=pathFrom))
+
+            # Log a start of download
+            fileid = self.logclass.logFileCreate(
+                '[{username}@{hostname}] {r}'.format(username=self.username,hostname=self.host,r=remotefile),
+                localfile
+            )
+            # Download file, paramiko prefetches the file with pipelined reads
+            t = self.metrics.start()
+            conn.get(remotefile,tmpfile)
+            self.metrics.stop(t,'get',self.section)
+            # Log a check of download
+            self.logclass.logFileCheck(fileid)
+
+            # Check the whole file is here
+            size = os.path.getsize(tmpfile)
+            if (self.verify != 'none') and (size != attr.st_size):
+                self.logclass.logError('Download failed, size {l} != {r}'.format(l=size,r=attr.st_size),self.lineno())
+                os.remove(tmpfile)
+                self.logclass.logFileFail(fileid)
+                self.metrics.count('files_failed',self.section)
+                return False
+
+            # Keep modification time of remote file and rename to final name
+            os.utime(tmpfile,(attr.st_atime,attr.st_mtime))
+            os.replace(tmpfile,localfile)
+
+            # Log a success of download
+            self.logclass.logFilePass(fileid,size)
+            self.metrics.count('files_downloaded',self.section)
+            self.metrics.count('bytes_downloaded',self.section,size)
+            return True
+        except Exception as e:
+            # Download failed
+            self.metrics.count('files_failed',self.section)
+            self.remote.invalidate(conn)
+            self.logclass.logError('Caught exception: {c}: {e}'.format(c=e.__class__,e=e),self.lineno())
+            self.logclass.logFileFail(fileid)
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            return False
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Upload "sfile" with sftp from local "pathFrom" to remote "pathTo"
+    # "conn" is a worker connection from the pool, or False to use the main connection
+    def __uploadFile_sftp(self,pathFrom,sfile1,pathTo,sfile2,conn=False):
+        if conn == False:
+            if self.conn == False:
+                # Connect to sftp
+                if not self.connect():
+                    return False
+            conn = self.conn
+        fileid = 0
+
+        if pathTo[-1] == '/':
+            # remove trailing delimiter
+            pathTo = pathTo[:-1]
+
+        try:
+            t = self.metrics.start()
+            b = self.__cwdRemote(conn,pathTo)
+            self.metrics.stop(t,'remote_dir',self.section)
+            if not b:
+                self.failures[os.path.join(pathFrom,sfile1)] = 'Remote directory {p}'.format(p=pathTo)
+                self.metrics.count('files_failed',self.section)
+                return False
+
+            # upload file
+            if sfile1 != sfile2:
+                # .. and renamed
+                self.logclass.logInfo('Upload {f1} to {pathTo} as {f2}'.format(f1=sfile1,pathTo=pathTo,f2=sfile2))
+            else:
+                self.logclass.logInfo('Upload {f1} to {pathTo}'.format(f1=sfile1,pathTo=pathTo))
+
+            # Log a start of upload
+            fileid = self.logclass.logFileCreate(
+                os.path.join(pathFrom,sfile1),
+                '[{username}@{hostname}] {r}'.format(username=self.username,hostname=self.host,r=self.joinpath(pathTo,sfile2))
+            )
+            # Upload file
+            t = self.metrics.start()
+            result = self.__putFile(conn,os.path.join(pathFrom,sfile1),self.joinpath(pathTo,sfile2))
+            self.metrics.stop(t,'put',self.section)
+            # Log a check of upload
+            self.logclass.logFileCheck(fileid)
+
+            # Check remote the file is actually there
+            t = self.metrics.start()
+            b = self.__verifyUpload(result)
+            self.metrics.stop(t,'verify',self.section)
+            if not b:
+                self.logclass.logError('Upload failed',self.lineno())
+                self.logclass.logFileFail(fileid)
+                self.failures[os.path.join(pathFrom,sfile1)] = 'Verification failed'
+                self.metrics.count('files_failed',self.section)
+                return False
+
+            if 'append' in result:
+                # Uploaded part of a file which may grow
+                self.getState().setAppend(os.path.join(pathFrom,sfile1),self.joinpath(pathTo,sfile2),result['append'][0],result['append'][1])
+
+            # Log a success of upload
+            sent = max(0,result.get('sent',result['size']))
+            self.logclass.logFilePass(fileid,sent)
+            self.metrics.count('files_uploaded',self.section)
+            self.metrics.count('bytes_uploaded',self.section,sent)
+            return True
+        except Exception as e:
+            # Upload failed
+            self.metrics.count('files_failed',self.section)
+            self.remote.invalidate(conn,pathTo)
+            self.logclass.logError('Caught exception: {c}: {e}'.format(c=e.__class__,e=e),self.lineno())
+            self.logclass.logFileFail(fileid)
+            self.failures[os.path.join(pathFrom,sfile1)] = '{c}: {e}'.format(c=e.__class__.__name__,e=e)
+            return False
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Upload local file to the main remote "pathTo" and to all targets of the set, reading it once: each block
+    # is written to the remote file of every target at the same time. Targets which have the file already
+    # (same modification time) are skipped, a failing target is dropped from the stream and the others
+    # continue. True when every target has the verified file, so type 1 moves it only then.
+    # "conn" is a worker connection from the pool (main remote), or False to use the main connection
+    def __uploadFanout_sftp(self,pathFrom,sfile1,pathTo,sfile2,conn=False):
+        localfile = os.path.join(pathFrom,sfile1)
+        state = self.getState()
+        st = os.stat(localfile)
+        mtime = str(st.st_mtime)
+        done = state.getTargets(self.section,localfile,mtime)
+        outs = []           # [name,transfer,remotefile,conn,pooled,rf,fileid,reason]
+        reasons = []
+        try:
+            # Open the remote file of each target not done
+            for (name,tr,path) in [('sftp',self,pathTo)] + self.targets:
+                if name in done:
+                    continue
+                if path[-1] == '/':
+                    # remove trailing delimiter
+                    path = path[:-1]
+                out = [name,tr,self.joinpath(path,sfile2),False,tr is not self,None,0,'']
+                outs.append(out)
+                if tr is not self:
+                    out[3] = tr.__getPoolConnection()
+                elif not conn == False:
+                    out[3] = conn
+                elif (not self.conn == False) or self.connect():
+                    out[3] = self.conn
+                if out[3] == False:
+                    out[7] = 'No connection'
+                    continue
+                t = self.metrics.start()
+                b = tr.__cwdRemote(out[3],path)
+                self.metrics.stop(t,'remote_dir',self.section)
+                if not b:
+                    out[7] = 'Remote directory {p}'.format(p=path)
+                    continue
+                self.logclass.logInfo('Upload {f1} to {h}:{f2}'.format(f1=sfile1,h=tr.host,f2=out[2]))
+                out[6] = self.logclass.logFileCreate(
+                    localfile,
+                    '[{username}@{hostname}] {r}'.format(username=tr.username,hostname=tr.host,r=out[2])
+                )
+                try:
+                    out[5] = out[3].open(out[2],'wb')
+                    out[5].set_pipelined(True)
+                    if hasattr(out[5],'MAX_REQUEST_SIZE'):
+                        out[5].MAX_REQUEST_SIZE = self.blockSize
+                except Exception as e:
+                    out[7] = '{c}: {e}'.format(c=e.__class__.__name__,e=e)
+
+            # Stream the file once into all open remote files
+            t = self.metrics.start()
+            h = hashlib.new(self.hashalg) if self.verify == 'hash' else None
+            size = st.st_size
+            if size > 0:
+                with open(localfile,'rb',buffering=0) as lf:
+                    for data in self.__readBlocks(lf,0,size):
+                        active = [out for out in outs if out[7] == '' and out[5] is not None]
+                        if len(active) == 0:
+                            break
+                        self.limit.take(len(data) * len(active))
+                        for out in active:
+                            try:
+                                out[5].write(data)
+                                out[1].__boundRequests(out[5])
+                            except Exception as e:
+                                out[7] = '{c}: {e}'.format(c=e.__class__.__name__,e=e)
+                        if h is not None:
+                            h.update(data)
+            self.metrics.stop(t,'put',self.section)
+
+            # Verify each target
+            for out in outs:
+                if (out[7] == '') and (out[5] is not None):
+                    self.logclass.logFileCheck(out[6])
+                    result = {'size': size, 'rsize': -1, 'hash': '', 'rhash': ''}
+                    try:
+                        if h is not None:
+                            result['hash'] = h.hexdigest()
+                            try:
+                                result['rhash'] = out[5].check(self.hashalg).hex()
+                            except IOError:
+                                pass
+                        if (self.verify != 'none') and (result['rhash'] == ''):
+                            result['rsize'] = out[5].stat().st_size
+                        out[5].close()
+                        out[5] = None
+                        if not self.__verifyUpload(result):
+                            out[7] = 'Verification failed'
+                    except Exception as e:
+                        out[7] = '{c}: {e}'.format(c=e.__class__.__name__,e=e)
+                if out[7] == '':
+                    state.setTarget(self.section,localfile,out[0],mtime)
+                    self.logclass.logFilePass(out[6],size)
+                    self.metrics.count('files_uploaded',self.section)
+                    self.metrics.count('bytes_uploaded',self.section,size)
+                else:
+                    self.logclass.logError('Upload to {t} failed: {r}'.format(t=out[0],r=out[7]),self.lineno())
+                    if out[6] > 0:
+                        self.logclass.logFileFail(out[6])
+                    self.metrics.count('files_failed',self.section)
+                    reasons.append('{t}: {r}'.format(t=out[0],r=out[7]))
+        except Exception as e:
+            # Failed before the targets were verified
+            self.logclass.logError('Caught exception: {c}: {e}'.format(c=e.__class__,e=e),self.lineno())
+            reasons.append('{c}: {e}'.format(c=e.__class__.__name__,e=e))
+            for out in outs:
+                if out[6] > 0:
+                    self.logclass.logFileFail(out[6])
+        finally:
+            for out in outs:
+                if out[5] is not None:
+                    try:
+                        out[5].close()
+                    except Exception as e:
+                        pass
+                if len(reasons) > 0 and (not out[3] == False):
+                    out[1].remote.invalidate(out[3],posixpath.dirname(out[2]))
+                if out[4]:
+                    out[1].__releasePoolConnection(out[3])
+
+        if len(reasons) > 0:
+            self.failures[localfile] = ', '.join(reasons)
+            return False
+        state.clearTargets(self.section,localfile)
+        return True
+
+##############################################################################
+## streamwriter class
+## File object for a stream written into an open remote file: counts and
+## optionally hashes the bytes, "written(f)" is called after each write.
+## With "limit" (ratelimit) each write waits for the bandwidth cap.
+##############################################################################
+class streamwriter:
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class
+    def __init__(self,f,h=None,written=None,limit=None):
+        self.f = f
+        self.h = h
+        self.written = written
+        self.limit = limit
+        self.size = 0
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Write data into remote file
+    def write(self,data):
+        if self.limit is not None:
+            self.limit.take(len(data))
+        self.f.write(data)
+        if self.h is not None:
+            self.h.update(data)
+        self.size += len(data)
+        if self.written is not None:
+            self.written(self.f)
+        return len(data)
+
+##############################################################################
+## asyncengine class
+## One SSH session with an asyncssh sftp client, run by an asyncio event loop
+## in a background thread. Many uploads can be in flight at the same time over
+## the single session, asyncssh also pipelines the requests of each file.
+## Used by transfer with conntype "asyncsftp" through asyncconnection.
+## Needs: sudo pip3 install asyncssh
+##############################################################################
+class asyncengine:
+    maxRequests = 64        # outstanding requests per file
+    blockSize = 32768
+    window = 0
+    maxPacket = 0
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class
+    def __init__(self,host='',port=22,username='',password='',privkey=''):
+        import asyncio
+        import asyncssh
+        self.asyncio = asyncio
+        self.asyncssh = asyncssh
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.privkey = privkey
+        self.ssh = None
+        self.sftp = None
+        self.alive = False
+        self.loop = self.asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,name='asyncengine',daemon=True)
+        self.thread.start()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Set tuning as transfer.setTuning, before connect
+    def setTuning(self,blockSize=32768,window=0,maxPacket=0,maxRequests=64):
+        self.blockSize = blockSize
+        self.window = window
+        self.maxPacket = maxPacket
+        self.maxRequests = maxRequests
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Run coroutine in event loop and wait for the result
+    def run(self,coro):
+        try:
+            return self.asyncio.run_coroutine_threadsafe(coro,self.loop).result()
+        except (self.asyncssh.DisconnectError,self.asyncssh.ConnectionLost,ConnectionError):
+            self.alive = False
+            raise
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Run coroutine in event loop, returns a future without waiting
+    def submit(self,coro):
+        return self.asyncio.run_coroutine_threadsafe(coro,self.loop)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Open SSH session and sftp client
+    def connect(self):
+        async def connect():
+            args = {'port': self.port, 'username': self.username, 'known_hosts': None}
+            if self.window > 0:
+                args['window'] = self.window
+            if self.maxPacket > 0:
+                args['max_pktsize'] = self.maxPacket
+            if self.privkey == '':
+                args['password'] = self.password
+            else:
+                args['client_keys'] = [self.privkey]
+            self.ssh = await self.asyncssh.connect(self.host,**args)
+            self.sftp = await self.ssh.start_sftp_client()
+        self.run(connect())
+        self.alive = True
+
+    # ---------------------------------------------------------------------------------------------------------
+    # True if session is usable
+    def isAlive(self):
+        return self.alive
+
+    # ---------------------------------------------------------------------------------------------------------
+    # fileattrs from asyncssh SFTPAttrs
+    def attrs(self,a,filename=''):
+        return fileattrs(
+            filename,
+            a.size if a.size is not None else -1,
+            a.mtime if a.mtime is not None else 0,
+            a.atime if a.atime is not None else 0,
+            a.permissions if a.permissions is not None else 0
+        )
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Close session and stop event loop
+    def close(self):
+        async def close():
+            if self.sftp is not None:
+                self.sftp.exit()
+            if self.ssh is not None:
+                self.ssh.close()
+                await self.ssh.wait_closed()
+        try:
+            self.run(close())
+        except Exception as e:
+            pass
+        self.alive = False
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+##############################################################################
+## fileattrs class
+## File attributes in the form transfer expects (as paramiko SFTPAttributes),
+## used by the asyncsftp and local transports
+##############################################################################
+class fileattrs:
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class
+    def __init__(self,filename='',size=-1,mtime=0,atime=0,mode=0):
+        self.filename = filename
+        self.st_size = size
+        self.st_mtime = mtime
+        self.st_atime = atime
+        self.st_mode = mode
+
+##############################################################################
+## asyncfile class
+## Remote file opened with asyncconnection.open. Writes are sent without
+## waiting, up to "maxRequests" of the engine at a time.
+##############################################################################
+class asyncfile:
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class
+    def __init__(self,engine,f):
+        self.engine = engine
+        self.f = f
+        self.offset = 0
+        self.pending = collections.deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,tb):
+        self.close()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Writes are always pipelined
+    def set_pipelined(self,pipelined=True):
+        pass
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Set offset of next write
+    def seek(self,offset):
+        self.offset = offset
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Send data at current offset
+    def write(self,data):
+        self.pending.append(self.engine.submit(self.f.write(data,self.offset)))
+        self.offset += len(data)
+        while len(self.pending) > self.engine.maxRequests:
+            self.pending.popleft().result()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Wait until all writes are done
+    def flush(self):
+        while len(self.pending) > 0:
+            self.pending.popleft().result()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Remote hash ("check-file") is not supported by asyncssh
+    def check(self,hash_algorithm,offset=0,length=0,block_size=0):
+        raise IOError('check-file not supported')
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Attributes of the open file
+    def stat(self):
+        self.flush()
+        return self.engine.attrs(self.engine.run(self.f.stat()))
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Close file
+    def close(self):
+        if self.f is not None:
+            try:
+                self.flush()
+            finally:
+                self.engine.run(self.f.close())
+                self.f = None
+
+##############################################################################
+## asyncconnection class
+## A view on asyncengine with the part of the pysftp.Connection interface
+## transfer uses, so all set types work with it. Each view keeps its own
+## current directory; all views of an engine share the one SSH session.
+##############################################################################
+class asyncconnection:
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class
+    def __init__(self,engine):
+        self.engine = engine
+        self.sftp_client = self
+        self.cwdpath = engine.run(engine.sftp.realpath('.'))
+
+    @property
+    def pwd(self):
+        return self.cwdpath
+
+    def cwd(self,path):
+        self.cwdpath = self.engine.run(self.engine.sftp.realpath(path))
+
+    def exists(self,path):
+        return self.engine.run(self.engine.sftp.exists(path))
+
+    def makedirs(self,path):
+        self.engine.run(self.engine.sftp.makedirs(path,exist_ok=True))
+
+    def mkdir(self,path):
+        self.engine.run(self.engine.sftp.mkdir(path))
+
+    def stat(self,path):
+        return self.engine.attrs(self.engine.run(self.engine.sftp.stat(path)))
+
+    def listdir_attr(self,path):
+        names = self.engine.run(self.engine.sftp.readdir(path))
+        return [self.engine.attrs(n.attrs,n.filename) for n in names if n.filename not in ('.','..')]
+
+    def remove(self,path):
+        self.engine.run(self.engine.sftp.remove(path))
+
+    def rename(self,oldpath,newpath):
+        self.engine.run(self.engine.sftp.rename(oldpath,newpath))
+
+    def posix_rename(self,oldpath,newpath):
+        self.engine.run(self.engine.sftp.posix_rename(oldpath,newpath))
+
+    def utime(self,path,times):
+        self.engine.run(self.engine.sftp.utime(path,times=times))
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Upload file, requests of the file are pipelined by asyncssh.
+    # Returns attributes of the remote file when "confirm" is set (size is checked as in pysftp).
+    def put(self,localpath,remotepath,confirm=True):
+        self.engine.run(self.engine.sftp.put(localpath,remotepath,block_size=self.engine.blockSize,max_requests=self.engine.maxRequests))
+        if confirm:
+            attrs = self.stat(remotepath)
+            if attrs.st_size != os.stat(localpath).st_size:
+                raise IOError('size mismatch in put! {r} != {l}'.format(r=attrs.st_size,l=os.stat(localpath).st_size))
+            return attrs
+        return None
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Download file, read requests are pipelined by asyncssh
+    def get(self,remotepath,localpath):
+        self.engine.run(self.engine.sftp.get(remotepath,localpath,block_size=self.engine.blockSize,max_requests=self.engine.maxRequests))
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Open remote file, mode as in pysftp ('wb', 'r+b', 'rb', 'ab')
+    def open(self,path,mode='r'):
+        return asyncfile(self.engine,self.engine.run(self.engine.sftp.open(path,mode)))
+
+    # ---------------------------------------------------------------------------------------------------------
+    # True if the session of the engine is usable
+    def isAlive(self):
+        return self.engine.isAlive()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # The session is closed by the engine
+    def close(self):
+        pass
+
+##############################################################################
+## localfile class
+## File opened with localconnection.open
+##############################################################################
+class localfile:
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class
+    def __init__(self,f):
+        self.f = f
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,tb):
+        self.close()
+
+    def set_pipelined(self,pipelined=True):
+        pass
+
+    def seek(self,offset):
+        self.f.seek(offset)
+
+    def read(self,size=-1):
+        return self.f.read(size)
+
+    def write(self,data):
+        self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Remote hash ("check-file") is not available, size is verified instead
+    def check(self,hash_algorithm,offset=0,length=0,block_size=0):
+        raise IOError('check-file not supported')
+
+    def stat(self):
+        self.f.flush()
+        st = os.fstat(self.f.fileno())
+        return fileattrs('',st.st_size,st.st_mtime,st.st_atime)
+
+    def close(self):
+        self.f.close()
+
+##############################################################################
+## localconnection class
+## Transport "local": a local directory used as remote with the part of the
+## pysftp.Connection interface transfer uses. Remote paths are taken below
+## the directory, so a set can be tested without a server.
+##############################################################################
+class localconnection:
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class, "root" is the directory used as remote "/"
+    def __init__(self,root):
+        self.root = os.path.abspath(root)
+        self.sftp_client = self
+        self.cwdpath = '/'
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Remote path as absolute remote path
+    def __remote(self,path):
+        return posixpath.normpath(posixpath.join(self.cwdpath,path))
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Local path of a remote path
+    def __local(self,path):
+        return os.path.join(self.root,self.__remote(path).lstrip('/'))
+
+    @property
+    def pwd(self):
+        return self.cwdpath
+
+    def cwd(self,path):
+        if not os.path.isdir(self.__local(path)):
+            raise IOError('No such directory : {p}'.format(p=path))
+        self.cwdpath = self.__remote(path)
+
+    def exists(self,path):
+        return os.path.exists(self.__local(path))
+
+    def makedirs(self,path):
+        os.makedirs(self.__local(path),exist_ok=True)
+
+    def mkdir(self,path):
+        os.mkdir(self.__local(path))
+
+    def stat(self,path):
+        st = os.stat(self.__local(path))
+        return fileattrs('',st.st_size,st.st_mtime,st.st_atime,st.st_mode)
+
+    def listdir_attr(self,path):
+        attrs = []
+        for entry in os.scandir(self.__local(path)):
+            st = entry.stat()
+            attrs.append(fileattrs(entry.name,st.st_size,st.st_mtime,st.st_atime,st.st_mode))
+        return attrs
+
+    def remove(self,path):
+        os.remove(self.__local(path))
+
+    def rename(self,oldpath,newpath):
+        os.rename(self.__local(oldpath),self.__local(newpath))
+
+    def posix_rename(self,oldpath,newpath):
+        os.replace(self.__local(oldpath),self.__local(newpath))
+
+    def utime(self,path,times):
+        os.utime(self.__local(path),times)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Copy file, returns attributes of the copy when "confirm" is set
+    def put(self,localpath,remotepath,confirm=True):
+        shutil.copyfile(localpath,self.__local(remotepath))
+        if confirm:
+            return self.stat(remotepath)
+        return None
+
+    def get(self,remotepath,localpath):
+        shutil.copyfile(self.__local(remotepath),localpath)
+
+    def open(self,path,mode='r'):
+        return localfile(open(self.__local(path),mode))
+
+    def isAlive(self):
+        return True
+
+    def close(self):
+        pass
+
+##############################################################################
+## dirwatch class
+## Watch local directories for new and changed files with inotify (Linux).
+## Events of a file are debounced: a file is reported once it has not changed
+## for "settle" seconds. If inotify is not available nothing is reported and
+## the caller must rescan the directories.
+##############################################################################
+class dirwatch:
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0x00000800
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class
+    def __init__(self,settle=2.0):
+        self.settle = settle
+        self.fd = -1
+        self.wds = {}           # watch descriptor => key
+        self.pending = {}       # (key,filename) => time of last event
+        self.overflow = False
+        try:
+            import ctypes
+            import ctypes.util
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+            self.fd = self.libc.inotify_init1(self.IN_NONBLOCK)
+        except Exception as e:
+            self.fd = -1
+
+    # ---------------------------------------------------------------------------------------------------------
+    # True if inotify is in use
+    def isActive(self):
+        return self.fd >= 0
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Watch directory "path", events are reported with "key"
+    def add(self,path,key):
+        if self.fd < 0:
+            return False
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_MODIFY | self.IN_CREATE | self.IN_ATTRIB
+        wd = self.libc.inotify_add_watch(self.fd,os.fsencode(path),mask)
+        if wd < 0:
+            return False
+        self.wds[wd] = key
+        return True
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Wait at most "timeout" seconds for events, returns {key: [filenames]} of files that have settled.
+    # Returns False when events were lost (queue overflow) and a full rescan is needed.
+    def poll(self,timeout=1.0):
+        if self.fd >= 0:
+            # Don't sleep past the time the next pending file settles
+            if len(self.pending) > 0:
+                timeout = min(timeout,max(0,min(self.pending.values()) + self.settle - time.time()))
+            r = select.select([self.fd],[],[],timeout)[0]
+            if len(r) > 0:
+                self.__read()
+        else:
+            time.sleep(timeout)
+
+        if self.overflow:
+            self.overflow = False
+            self.pending = {}
+            return False
+
+        # Files without events for "settle" seconds are ready
+        now = time.time()
+        ready = {}
+        for (key,sfile) in list(self.pending.keys()):
+            if now - self.pending[(key,sfile)] >= self.settle:
+                del self.pending[(key,sfile)]
+                ready.setdefault(key,[]).append(sfile)
+        return ready
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Read available events
+    def __read(self):
+        try:
+            data = os.read(self.fd,65536)
+        except BlockingIOError:
+            return
+        now = time.time()
+        i = 0
+        while i + 16 <= len(data):
+            (wd,mask,cookie,size) = struct.unpack_from('iIII',data,i)
+            name = data[i+16:i+16+size].rstrip(b'\0')
+            i += 16 + size
+            if mask & self.IN_Q_OVERFLOW:
+                self.overflow = True
+            elif (wd in self.wds) and (name != b'') and not (mask & self.IN_ISDIR):
+                self.pending[(self.wds[wd],os.fsdecode(name))] = now
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Stop watching
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+##############################################################################
+## filestate class
+## Local SQLite database keeping file timestamps for each section. The database
+## is opened once per run, a section is read in one query and changes are
+## written in batches.
+##############################################################################
+class filestate:
+    db = False
+    dbfile = ''
+    batchSize = 500
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class
+    def __init__(self,dbfile='',batchSize=500):
+        self.dbfile = dbfile
+        self.batchSize = batchSize
+        self.db = False
+        self.sections = {}      # section => {filename: ts}
+        self.pending = []       # (section,filename,ts) not yet written
+        self.retries = {}       # section => {filename: (attempts,reason,nexttry,mtime,quarantined)}
+        self.targets = {}       # section => {filename: {target: mtime}} of fan-out uploads not yet done everywhere
+        self.idle = False       # section => (signature,until) of sets with nothing to send, see getIdle
+        self.lock = threading.Lock()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Open database (or create it if it doesn't exist)
+    def open(self):
+        if self.db == False:
+            import sqlite3
+            self.db = sqlite3.connect(self.dbfile,check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+        return self.db
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Read all timestamps of a section into memory
+    def loadSection(self,section):
+        with self.lock:
+            if section in self.sections:
+                return
+            db = self.open()
+            db.execute('CREATE TABLE IF NOT EXISTS "{t}" (filename TEXT PRIMARY KEY, ts TEXT)'.format(t=section))
+            db.commit()
+            rows = db.execute('SELECT filename,ts FROM "{t}"'.format(t=section)).fetchall()
+            self.sections[section] = {r[0]: str(r[1]) for r in rows}
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Get stored timestamp of file, empty string if not found
+    def getTimestamp(self,section,filename):
+        if section not in self.sections:
+            self.loadSection(section)
+        return self.sections[section].get(filename,'')
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Store timestamp of file. Written to database when the batch is full or on flush.
+    def setTimestamp(self,section,filename,ts):
+        if section not in self.sections:
+            self.loadSection(section)
+        with self.lock:
+            self.sections[section][filename] = ts
+            self.pending.append((section,filename,ts))
+            if len(self.pending) >= self.batchSize:
+                self.__flush()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Write pending timestamps in a single transaction (lock must be held)
+    def __flush(self):
+        if len(self.pending) == 0:
+            return
+        db = self.open()
+        bysection = {}
+        for (section,filename,ts) in self.pending:
+            bysection.setdefault(section,[]).append((filename,ts))
+        with db:
+            for section in bysection:
+                db.executemany('REPLACE INTO "{t}" (filename,ts) VALUES (?,?)'.format(t=section),bysection[section])
+        self.pending = []
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Write pending timestamps
+    def flush(self):
+        with self.lock:
+            self.__flush()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Create table of large file upload progress
+    def __uploadsTable(self):
+        db = self.open()
+        db.execute('CREATE TABLE IF NOT EXISTS "_uploads" (localfile TEXT, remotefile TEXT, size INTEGER, mtime TEXT, offset INTEGER, PRIMARY KEY (localfile,remotefile))')
+        return db
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Get progress of a large file upload, returns (size,mtime,offset) or False
+    def getUpload(self,localfile,remotefile):
+        with self.lock:
+            db = self.__uploadsTable()
+            row = db.execute('SELECT size,mtime,offset FROM "_uploads" WHERE localfile=? AND remotefile=?',(localfile,remotefile)).fetchone()
+            if row is None:
+                return False
+            return (row[0],row[1],row[2])
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Store progress of a large file upload (written immediately)
+    def setUpload(self,localfile,remotefile,size,mtime,offset):
+        with self.lock:
+            db = self.__uploadsTable()
+            with db:
+                db.execute('REPLACE INTO "_uploads" (localfile,remotefile,size,mtime,offset) VALUES (?,?,?,?,?)',(localfile,remotefile,size,mtime,offset))
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Remove progress of a large file upload
+    def clearUpload(self,localfile,remotefile):
+        with self.lock:
+            db = self.__uploadsTable()
+            with db:
+                db.execute('DELETE FROM "_uploads" WHERE localfile=? AND remotefile=?',(localfile,remotefile))
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Sets which had nothing to send: signature of their files then and the time that stays valid (first
+    # waiting retry due). Kept in "<dbfile>.idle" (json), so it's checked without opening the database.
+    # Returns (signature,until) or False.
+    def getIdle(self,section):
+        with self.lock:
+            if self.idle == False:
+                self.idle = {}
+                if os.path.exists(self.dbfile):
+                    # Only valid with the database it was made from
+                    try:
+                        with open(self.dbfile + '.idle') as f:
+                            self.idle = json.load(f)
+                    except (OSError,ValueError):
+                        pass
+            return self.idle.get(section,False)
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Store set having nothing to send with "signature" of its files, valid until "until"
+    def setIdle(self,section,signature,until):
+        self.getIdle(section)
+        with self.lock:
+            self.idle[section] = (signature,until)
+            self.__writeIdle()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Set has something to send
+    def clearIdle(self,section):
+        if self.getIdle(section) != False:
+            with self.lock:
+                self.idle.pop(section,None)
+                self.__writeIdle()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Write idle sets (lock must be held)
+    def __writeIdle(self):
+        tmpfile = self.dbfile + '.idle.tmp'
+        try:
+            with open(tmpfile,'w') as f:
+                json.dump(self.idle,f)
+            os.replace(tmpfile,self.dbfile + '.idle')
+        except OSError:
+            # Checked with the database next time
+            pass
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Time the first waiting retry of a section is due (far future if none)
+    def nextRetry(self,section):
+        if section not in self.retries:
+            self.loadRetries(section)
+        with self.lock:
+            waiting = [r[2] for r in self.retries[section].values() if not r[4]]
+        return min(waiting) if len(waiting) > 0 else 4102444800.0
 
     # ---------------------------------------------------------------------------------------------------------
-    # Some directories have additional macros
-    def __chgPath(self,path):
-        # {date#1} => YYYYMMDD
-        return path.replace('{date#1}',self.ts.strftime('%Y%m%d'))
+    # Read failed uploads of a section into memory
+    def loadRetries(self,section):
+        with self.lock:
+            if section in self.retries:
+                return
+            db = self.open()
+            db.execute('CREATE TABLE IF NOT EXISTS "_retries" (section TEXT, filename TEXT, attempts INTEGER, reason TEXT, nexttry REAL, mtime TEXT, quarantined INTEGER, PRIMARY KEY (section,filename))')
+            db.commit()
+            rows = db.execute('SELECT filename,attempts,reason,nexttry,mtime,quarantined FROM "_retries" WHERE section=?',(section,)).fetchall()
+            self.retries[section] = {r[0]: (r[1],r[2],r[3],r[4],r[5] == 1) for r in rows}
 
     # ---------------------------------------------------------------------------------------------------------
-    # Connect to remote sftp
-    def connect(self):
-        self.logclass.logInfo('Connect to {host} using {conntype}'.format(host=self.host,conntype=self.conntype))
-        if self.conntype == 'sftp':
+    # Get failed upload of file, returns (attempts,reason,nexttry,mtime,quarantined) or False
+    def getRetry(self,section,filename):
+        if section not in self.retries:
+            self.loadRetries(section)
+        return self.retries[section].get(filename,False)
 
-            # TODO: For now we disable hostkey checking, should be on ...
-            cnopts = pysftp.CnOpts()
-            cnopts.hostkeys = None
+    # ---------------------------------------------------------------------------------------------------------
+    # Store failed upload of file (written immediately)
+    def setRetry(self,section,filename,attempts,reason,nexttry,mtime,quarantined=False):
+        if section not in self.retries:
+            self.loadRetries(section)
+        with self.lock:
+            self.retries[section][filename] = (attempts,reason,nexttry,mtime,quarantined)
+            db = self.open()
+            with db:
+                db.execute('REPLACE INTO "_retries" (section,filename,attempts,reason,nexttry,mtime,quarantined) VALUES (?,?,?,?,?,?,?)',
+                    (section,filename,attempts,reason,nexttry,mtime,1 if quarantined else 0))
 
-            if self.privkey == '':
-                # Auth with user/password
-                try:
-                    self.logclass.logInfo('Auth with password')
-                    self.conn = pysftp.Connection(self.host,username=self.username,password=self.password,cnopts=cnopts)
-                except Exception as e:
-                    self.logclass.logError('Failed to connect',self.lineno())
-                    self.conn = False
-                    return False
-            else:
-                # Auth with user/privkey
-                try:
-                    if self.privkey[0] != '/':
-                        ppk = os.path.join(self.basepath, self.privkey)
-                    else:
-                        ppk = self.privkey
-                    # self.logclass.logInfo('Using private key {f}'.format(f=ppk))
-                    self.logclass.logInfo('Auth with private key')
-                    self.conn = pysftp.Connection(self.host,username=self.username,private_key=ppk,cnopts=cnopts)
-                except Exception as e:
-                    self.logclass.logError('Failed to connect',self.lineno())
-                    self.conn = False
-                    return False
+    # ---------------------------------------------------------------------------------------------------------
+    # Remove failed upload of file
+    def clearRetry(self,section,filename):
+        if section not in self.retries:
+            self.loadRetries(section)
+        with self.lock:
+            if self.retries[section].pop(filename,False) != False:
+                db = self.open()
+                with db:
+                    db.execute('DELETE FROM "_retries" WHERE section=? AND filename=?',(section,filename))
 
-            # Save current remote path
-            self.pwd = self.conn.pwd
+    # ---------------------------------------------------------------------------------------------------------
+    # Remove failed uploads of a section whose file no longer exists, returns the number removed
+    def pruneRetries(self,section):
+        if section not in self.retries:
+            self.loadRetries(section)
+        with self.lock:
+            gone = [f for f in self.retries[section] if not os.path.exists(f)]
+            if len(gone) == 0:
+                return 0
+            for f in gone:
+                del self.retries[section][f]
+            db = self.open()
+            with db:
+                db.executemany('DELETE FROM "_retries" WHERE section=? AND filename=?',[(section,f) for f in gone])
+        return len(gone)
 
-            # Success
-            return True
-        else:
-            # Not supported
-            self.logclass.logError('Unknown conntype',self.lineno())
-            return False
+    # ---------------------------------------------------------------------------------------------------------
+    # Quarantined files of a section
+    def getQuarantined(self,section):
+        if section not in self.retries:
+            self.loadRetries(section)
+        with self.lock:
+            return sorted(f for f in self.retries[section] if self.retries[section][f][4])
 
     # ---------------------------------------------------------------------------------------------------------
-    # Disconnect sftp
-    def disconnect(self):
-        if not self.conn == False:
-            if self.conntype == 'sftp':
-                # We have a connection; disconnect
-                self.conn.close()
-                self.logclass.logInfo('Remote disconnected')
+    # Read targets having the file of fan-out uploads of a section into memory
+    def __loadTargets(self,section):
+        if section in self.targets:
+            return
+        db = self.open()
+        db.execute('CREATE TABLE IF NOT EXISTS "_targets" (section TEXT, filename TEXT, target TEXT, mtime TEXT, PRIMARY KEY (section,filename,target))')
+        db.commit()
+        self.targets[section] = {}
+        for r in db.execute('SELECT filename,target,mtime FROM "_targets" WHERE section=?',(section,)).fetchall():
+            self.targets[section].setdefault(r[0],{})[r[1]] = r[2]
 
     # ---------------------------------------------------------------------------------------------------------
-    # Get current line in code when called
-    def lineno(self):
-        return inspect.currentframe().f_back.f_lineno
+    # Targets having file uploaded with modification time "mtime"
+    def getTargets(self,section,filename,mtime):
+        with self.lock:
+            self.__loadTargets(section)
+            done = self.targets[section].get(filename,{})
+            return set(target for target in done if done[target] == mtime)
 
     # ---------------------------------------------------------------------------------------------------------
-    # Joining path for remote sftp
-    def joinpath(self,p1,p2):
-        if not p1.endswith('/'):
-            p1 += '/'
-        return p1+p2
+    # Store target having file uploaded (written immediately)
+    def setTarget(self,section,filename,target,mtime):
+        with self.lock:
+            self.__loadTargets(section)
+            self.targets[section].setdefault(filename,{})[target] = mtime
+            db = self.open()
+            with db:
+                db.execute('REPLACE INTO "_targets" (section,filename,target,mtime) VALUES (?,?,?,?)',(section,filename,target,mtime))
 
     # ---------------------------------------------------------------------------------------------------------
-    # Include files depending on extension
-    # Returns tuple (stat,filename):
-    #  stat => False if excluded, True if included
-    #  filename => The extension can be changed during upload. This is the name of the file as uploaded.
-    def __checkFilteringInclude(self,sfile='',extFilterInc=''):
-        if (extFilterInc != '') and (len(extFilterInc.split(',')) > 0):
-            for ext in extFilterInc.split(','):
-                extc = ext.split(':')
-                m = re.search('\.{e}$'.format(e=extc[0]), sfile, re.I)
-                if m:
-                    # extension matched => include
-                    if len(extc) > 1:
-                        # change extension of file
-                        sfile='{f}.{e}'.format(f=os.path.splitext(sfile)[0],e=extc[1])
-                    return (True,sfile)
-            # Nothing matched => exclude
-            return (False,sfile)
-        else:
-            # no filtering => include
-            return (True,sfile)
+    # Remove targets of file, all have it
+    def clearTargets(self,section,filename):
+        with self.lock:
+            self.__loadTargets(section)
+            if self.targets[section].pop(filename,None) is not None:
+                db = self.open()
+                with db:
+                    db.execute('DELETE FROM "_targets" WHERE section=? AND filename=?',(section,filename))
 
     # ---------------------------------------------------------------------------------------------------------
-    # Exclude files depending on extension
-    # False if excluded, True if included
-    def __checkFilteringExclude(self,sfile='',extFilterExc=''):
-        if len(extFilterExc.split(',')) > 0:
-            for ext in extFilterExc.split(','):
-                m = re.search('\.{e}$'.format(e=ext), sfile, re.I)
-                if m:
-                    # extension match => exclude
-                    return False
-        return True
+    # Create table of files uploaded in append mode
+    def __appendsTable(self):
+        db = self.open()
+        db.execute('CREATE TABLE IF NOT EXISTS "_appends" (localfile TEXT, remotefile TEXT, size INTEGER, fingerprint TEXT, PRIMARY KEY (localfile,remotefile))')
+        return db
 
     # ---------------------------------------------------------------------------------------------------------
-    # A SQLite database can store file timestamps for each section when needed.
-    # This is used for preventing upload of a file which has not changed.
-    def __checkTimestampFromSQLite(self,section='',sfile=''):
-        # Get file modified timestamp
-        if not os.path.isfile(sfile):
-            # File not found
-            return False
+    # Get uploaded size and fingerprint of a file uploaded in append mode, returns (size,fingerprint) or False
+    def getAppend(self,localfile,remotefile):
+        with self.lock:
+            db = self.__appendsTable()
+            row = db.execute('SELECT size,fingerprint FROM "_appends" WHERE localfile=? AND remotefile=?',(localfile,remotefile)).fetchone()
+            if row is None:
+                return False
+            return (row[0],row[1])
 
-        # Get file modification time as string
-        tsfile = str(os.path.getmtime(sfile))
+    # ---------------------------------------------------------------------------------------------------------
+    # Store uploaded size and fingerprint of a file uploaded in append mode (written immediately)
+    def setAppend(self,localfile,remotefile,size,fingerprint):
+        with self.lock:
+            db = self.__appendsTable()
+            with db:
+                db.execute('REPLACE INTO "_appends" (localfile,remotefile,size,fingerprint) VALUES (?,?,?,?)',(localfile,remotefile,size,fingerprint))
 
-        # Open database (or create it if it doesn't exist)
-        db = sqlite3.connect('{sid}.db'.format(sid=self.sid))
-        cur = db.cursor()
+    # ---------------------------------------------------------------------------------------------------------
+    # Write pending timestamps and close database
+    def close(self):
+        with self.lock:
+            if not self.db == False:
+                self.__flush()
+                self.db.close()
+                self.db = False
+            self.sections = {}
+            self.retries = {}
+            self.targets = {}
+            self.idle = False
 
-        # Create table if not exist
-        sql = 'CREATE TABLE IF NOT EXISTS "{t}" (filename TEXT PRIMARY KEY, ts TEXT)'.format(t=section)
-        cur.execute(sql)
-        db.commit()
+##############################################################################
+## dbwriter class
+## Background writer of log lines and file events into the "transfers" database.
+## Events are put into a bounded queue and written by a thread in batches, when
+## the batch is full or after "flushInterval" seconds. When the database can't
+## be reached the events are appended to a local spill file, which is written to
+## the database once it's reachable again.
+##############################################################################
+class dbwriter:
+    queueSize = 10000
+    batchSize = 200
+    flushInterval = 2.0
+    retryInterval = 30.0
 
-        # Get file timestamp from db
-        arr = (sfile,)
-        cur.execute('SELECT ts FROM "{t}" WHERE filename=?'.format(t=section),arr)
-        rows = cur.fetchall()
-        if len(rows) != 1:
-            # Too many matches, should only be one
-            cur.execute('DELETE FROM "{t}" WHERE filename=?'.format(t=section),arr)
-            db.commit()
-            ts = ''
-        else:
-            # Get timestamp from db (as string)
-            ts = str(rows[0][0])
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class
+    def __init__(self,sid='',config={},myconn=False,spillfile='',logger=False):
+        self.sid = sid
+        self.config = config
+        self.myconn = myconn
+        self.metrics = metrics()
+        self.spillfile = spillfile
+        self.logger = logger
+        self.idcust = 0
+        self.lastConnect = time.time() if not myconn == False else 0      # first connect is done on first write
+        self.run = '{p}-{t}'.format(p=os.getpid(),t=int(time.time()*1000))   # identifies file events of this run
+        self.lid = 0
+        self.ids = {}           # (run,lid) => (idfiles,tsstart) in database
+        self.lidLock = threading.Lock()
+        self.spillLock = threading.Lock()
+        self.queue = queue.Queue(maxsize=self.queueSize)
+        self.thread = threading.Thread(target=self.__run,name='dbwriter',daemon=True)
+        self.thread.start()
 
-        if ts != tsfile:
-            # Different
-            arr = (sfile,tsfile)
-            cur.execute('REPLACE INTO "{t}" (filename,ts) VALUES (?,?)'.format(t=section),arr)
-            db.commit()
-            db.close()
-            return True     # Indicate file is different
-        else:
-            # No change in timestamp
-            db.close()
-            return False    # Indicate file is same
+    # ---------------------------------------------------------------------------------------------------------
+    # Current time as database timestamp
+    def now(self):
+        return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
     # ---------------------------------------------------------------------------------------------------------
-    # Transfer all files from single "directory" to remote site "directory". 
-    # After succesfull transfer move the file from "directory" to "transfered directory"
-    def doType1(self,pathFrom='',pathTo='',pathTransfered='',extFilterInc='',extFilterExc=''):
-        if self.conntype == 'sftp':
-            self.__doType1_sftp(
-                pathFrom, pathTo,
-                self.__chgPath(pathTransfered),             # Check for macros
-                extFilterInc, extFilterExc
-            )
-        else:
-            self.logclass.logError('doType1 conntype not supported yet',self.lineno())
+    # Get a new local id for a file event
+    def newId(self):
+        with self.lidLock:
+            self.lid += 1
+            return self.lid
 
     # ---------------------------------------------------------------------------------------------------------
-    # doType1 with sftp
-    def __doType1_sftp(self,pathFrom='',pathTo='',pathTransfered='',extFilterInc='',extFilterExc=''):
-        if not os.path.exists(pathFrom):
-            self.logclass.logError('Directory does not exists : {d}'.format(d=pathFrom),self.lineno())
-            return False
+    # Queue a log line
+    def putLog(self,st,msg):
+        self.__put(('L',self.now(),st,msg))
 
-        # Create some directories
-        if pathTransfered != '':
-            if not os.path.exists(pathTransfered):
-                self.logclass.logInfo('Creating directory {d}'.format(d=pathTransfered))
-                os.makedirs(pathTransfered)
-                if not os.path.exists(pathTransfered):
-                    self.logclass.logError('Failed to create : {d}'.format(d=pathTransfered),self.lineno())
-                    return False
+    # ---------------------------------------------------------------------------------------------------------
+    # Queue a file event: U (upload start), C (check), S (success) or F (fail)
+    def putFile(self,ev,lid,ffile='',tfile=''):
+        if ev == 'U':
+            self.__put(('U',self.now(),self.run,lid,ffile,tfile))
+        else:
+            self.__put((ev,self.now(),self.run,lid))
 
-        # Go through all files in directory
-        for sfile in os.listdir(pathFrom):
-            if not os.path.isdir(os.path.join(pathFrom,sfile)):
-                # Check filtering (exclude overrides include filtering)
-                b = self.__checkFilteringExclude(sfile,extFilterExc)
-                if not b:
-                    self.logclass.logInfo('File {f} excluded due to Exc filtering'.format(f=sfile))
-                else:
-                    (b,sfile2) = self.__checkFilteringInclude(sfile,extFilterInc)
-                    if not b:
-                        self.logclass.logInfo('File {f} excluded due to Inc filtering'.format(f=sfile))
-                    else:
-                        # Upload file
-                        if self.__uploadFile_sftp(pathFrom,sfile,pathTo,sfile2):
-                            if pathTransfered != '':
-                                try:
-                                    # Move the file to another directory
-                                    self.logclass.logInfo('Move file to transfer directory')
-                                    shutil.move(os.path.join(pathFrom,sfile),os.path.join(pathTransfered,sfile))
-                                except Exception as e:
-                                    self.logclass.logError('Failed to move file : {f}'.format(f=sfile),self.lineno())
+    # ---------------------------------------------------------------------------------------------------------
+    # Put into queue without blocking, spill to file if the queue is full
+    def __put(self,item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.__spill([item])
 
     # ---------------------------------------------------------------------------------------------------------
-    # Transfer all files from single "directory" to remote site "directory". 
-    def doType2(self,section='',pathFrom='',pathTo='',extFilterInc='',extFilterExc=''):
-        if self.conntype == 'sftp':
-            self.__doType2_sftp(section,pathFrom,pathTo,extFilterInc,extFilterExc)
-        else:
-            self.logclass.logError('doType2 conntype not supported yet',self.lineno())
+    # Write remaining events and stop the writer
+    def close(self):
+        self.queue.put(('X',))
+        self.thread.join()
+        if not self.myconn == False:
+            try:
+                self.myconn.close()
+            except Exception as e:
+                pass
+            self.myconn = False
 
     # ---------------------------------------------------------------------------------------------------------
-    # doType2 with sftp
-    def __doType2_sftp(self,section='',pathFrom='',pathTo='',extFilterInc='',extFilterExc=''):
-        if not os.path.exists(pathFrom):
-            self.logclass.logError('Directory does not exists : {d}'.format(d=pathFrom),self.lineno())
-            return False
+    # Writer thread
+    def __run(self):
+        batch = []
+        first = 0
+        while True:
+            if len(batch) == 0:
+                timeout = None
+            else:
+                timeout = max(0,first + self.flushInterval - time.time())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if (item is not None) and (item[0] == 'X'):
+                # Closing
+                self.__flush(batch)
+                return
+            if item is not None:
+                if len(batch) == 0:
+                    first = time.time()
+                batch.append(item)
+            if (len(batch) > 0) and ((item is None) or (len(batch) >= self.batchSize) or (time.time() - first >= self.flushInterval)):
+                self.__flush(batch)
+                batch = []
 
-        # Go through all files in directory
-        for sfile in os.listdir(pathFrom):
-            if not os.path.isdir(os.path.join(pathFrom,sfile)):
-                # Check filtering (exclude overrides include filtering)
-                b = self.__checkFilteringExclude(sfile,extFilterExc)
-                if b:
-                    (b,sfile2) = self.__checkFilteringInclude(sfile,extFilterInc)
-                    if b:
-                        # Check db regarding file if timestamp has changed
-                        b = self.__checkTimestampFromSQLite(section,os.path.join(pathFrom,sfile))
-                        if b:
-                            # Upload file
-                            self.__uploadFile_sftp(pathFrom,sfile,pathTo,sfile2)
-                        #else:
-                        #    self.logclass.logInfo('File {f} timestamp has not changed'.format(f=sfile))
-                    #else:
-                    #    self.logclass.logInfo('File {f} excluded due to Inc filtering'.format(f=sfile))
-                #else:
-                #    self.logclass.logInfo('File {f} excluded due to Exc filtering'.format(f=sfile))
+    # ---------------------------------------------------------------------------------------------------------
+    # Log error of the writer into file only
+    def __error(self,msg):
+        if not self.logger == False:
+            self.logger.error(msg)
 
     # ---------------------------------------------------------------------------------------------------------
-    # Upload "sfile" with sftp from local "pathFrom" to remote "pathTo"
-    def __uploadFile_sftp(self,pathFrom,sfile1,pathTo,sfile2):
-        if self.conn == False:
-            # Connect to sftp
-            if not self.connect():
+    # Make sure we have a database connection, reconnect every "retryInterval" seconds
+    def __connected(self):
+        if self.myconn == False:
+            if (len(self.config) == 0) or (time.time() - self.lastConnect < self.retryInterval):
+                return False
+            self.lastConnect = time.time()
+            try:
+                import mysql.connector
+                self.myconn = mysql.connector.Connect(**self.config)
+            except Exception as e:
+                self.__error('Database reconnect failed: {c}: {e}'.format(c=e.__class__,e=e))
+                self.myconn = False
+                return False
+        if self.idcust == 0:
+            # Resolve customer id once
+            try:
+                cur = self.myconn.cursor()
+                cur.execute('SELECT idcust FROM customers WHERE customer=%s',(self.sid,))
+                rows = cur.fetchall()
+                if len(rows) == 0:
+                    cur.execute('INSERT INTO customers (customer) VALUES (%s)',(self.sid,))
+                    self.idcust = cur.lastrowid
+                    self.myconn.commit()
+                else:
+                    self.idcust = rows[0][0]
+                cur.close()
+            except Exception as e:
+                self.__error('Caught exception: {c}: {e}'.format(c=e.__class__,e=e))
+                self.__disconnect()
                 return False
+        return True
 
-        if pathTo[-1] == '/':
-            # remove trailing delimiter
-            pathTo = pathTo[:-1]
+    # ---------------------------------------------------------------------------------------------------------
+    # Drop the database connection after an error
+    def __disconnect(self):
+        if not self.myconn == False:
+            try:
+                self.myconn.close()
+            except Exception as e:
+                pass
+        self.myconn = False
+        self.lastConnect = time.time()
 
+    # ---------------------------------------------------------------------------------------------------------
+    # Write a batch into database, or into the spill file when database is not reachable
+    def __flush(self,batch):
+        t = self.metrics.start()
+        if not self.__connected():
+            self.__spill(batch)
+            self.metrics.count('db_spilled',value=len(batch))
+            return
         try:
-            if self.conn.pwd != pathTo:
-                # Uploading to different directory than current
+            self.__replay()
+            self.__write(batch)
+            self.metrics.count('db_written',value=len(batch))
+        except Exception as e:
+            self.__error('Caught exception: {c}: {e}'.format(c=e.__class__,e=e))
+            self.__disconnect()
+            self.__spill(batch)
+            self.metrics.count('db_spilled',value=len(batch))
+        self.metrics.stop(t,'db')
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Append events into the spill file as json lines
+    def __spill(self,items):
+        if (self.spillfile == '') or (len(items) == 0):
+            return
+        with self.spillLock:
+            try:
+                with open(self.spillfile,'a') as f:
+                    for item in items:
+                        f.write(json.dumps(item) + '\n')
+            except Exception as e:
+                self.__error('Failed to write spill file : {f}'.format(f=self.spillfile))
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Write spilled events into database
+    def __replay(self):
+        if self.spillfile == '':
+            return
+        replayfile = self.spillfile + '.replay'
+        with self.spillLock:
+            if (not os.path.isfile(replayfile)) and os.path.isfile(self.spillfile):
+                os.rename(self.spillfile,replayfile)
+        if not os.path.isfile(replayfile):
+            return
+        items = []
+        with open(replayfile) as f:
+            for line in f:
                 try:
-                    if not self.conn.exists(pathTo):
-                        self.logclass.logInfo('Create remote directory : {p}'.format(p=pathTo))
-                        self.conn.makedirs(pathTo)            
-                    # Next lines is actually not needed as sftp should upload to whatever directory the upload points to.
-                    # For some reason got an error with a server which failed to upload the file if the current location
-                    # was not the actual upload folder; too strict security? Well, this fixed it.
-                    self.conn.cwd(pathTo)
-                    if self.conn.pwd != pathTo:
-                        self.logclass.logError('Failed to cwd to : {p}'.format(p=pathTo),self.lineno())
-                        return False
-                except Exception as e:
-                    self.logclass.logError('Failed to create remote folder(s) : {p}'.format(p=pathTo),self.lineno())
-                    return False
+                    items.append(tuple(json.loads(line)))
+                except ValueError:
+                    pass
+        self.__write(items,replay=True)
+        os.remove(replayfile)
 
-            # upload file
-            if sfile1 != sfile2:
-                # .. and renamed
-                self.logclass.logInfo('Upload {f1} to {pathTo} as {f2}'.format(f1=sfile1,pathTo=pathTo,f2=sfile2))
+    # ---------------------------------------------------------------------------------------------------------
+    # Write events into database in one transaction
+    # Log lines are inserted with a multi-row insert. File events which are completed within the batch
+    # are merged into a single row and also inserted with a multi-row insert.
+    def __write(self,items,replay=False):
+        logs = []
+        files = {}      # (run,lid) => [tsstart,tsend,ffile,tfile,status]
+        updates = []    # (event,ts,(run,lid))
+        for item in items:
+            if item[0] == 'L':
+                logs.append((item[1],self.idcust,item[3],'E' if item[2] in ('E','C') else 'I'))
+            elif item[0] == 'U':
+                files[(item[2],item[3])] = [item[1],'0000-00-00 00:00:00',item[4],item[5],'U']
             else:
-                self.logclass.logInfo('Upload {f1} to {pathTo}'.format(f1=sfile1,pathTo=pathTo))
-
-            # Log a start of upload
-            self.logclass.logFileCreate(
-                os.path.join(pathFrom,sfile1),
-                '[{username}@{hostname}] {r}'.format(username=self.username,hostname=self.host,r=self.joinpath(pathTo,sfile2))
-            )
-            # Upload file
-            self.conn.put(os.path.join(pathFrom,sfile1),self.joinpath(pathTo,sfile2))
-            # Log a check of upload
-            self.logclass.logFileCheck()
+                key = (item[2],item[3])
+                if key in files:
+                    rec = files[key]
+                    if item[0] != 'F':
+                        rec[1] = item[1]
+                    rec[4] = item[0]
+                else:
+                    updates.append((item[0],item[1],key))
 
-            # Check remote the file is actually there
+        newids = {}
+        orphans = []
+        cur = self.myconn.cursor()
+        try:
+            if len(logs) > 0:
+                cur.executemany('INSERT INTO log (ts,idcust,msg,etype) VALUES (%s,%s,%s,%s)',logs)
+            done = []
+            for key in files:
+                rec = files[key]
+                if rec[4] in ('S','F'):
+                    done.append((self.idcust,rec[0],rec[1],rec[2],rec[3],rec[4]))
+                else:
+                    # Still running, we need the id for later updates
+                    cur.execute('INSERT INTO files (idcust,tsstart,tsend,fromfile,tofile,status) VALUES (%s,%s,%s,%s,%s,%s)',
+                        (self.idcust,rec[0],rec[1],rec[2],rec[3],rec[4]))
+                    newids[key] = (cur.lastrowid,rec[0])
+            if len(done) > 0:
+                cur.executemany('INSERT INTO files (idcust,tsstart,tsend,fromfile,tofile,status) VALUES (%s,%s,%s,%s,%s,%s)',done)
+            # Status updates, only the last event of a file in the batch is written.
+            # tsstart is given so only the partition of the row is searched.
+            last = {}
+            for (ev,ts,key) in updates:
+                rec = self.ids.get(key,newids.get(key,False))
+                if rec == False:
+                    # Upload start not written yet (spilled), keep for later. Events of earlier runs are dropped.
+                    if key[0] == self.run and not replay:
+                        orphans.append((ev,ts,key[0],key[1]))
+                    continue
+                if ev == 'F':
+                    tsend = last[key][1] if key in last else None
+                    last[key] = ('F',tsend,rec)
+                else:
+                    last[key] = (ev,ts,rec)
+            done = []
+            failed = []
+            for key in last:
+                (ev,ts,rec) = last[key]
+                if ts is None:
+                    failed.append((ev,rec[0],rec[1]))
+                else:
+                    done.append((ts,ev,rec[0],rec[1]))
+                if ev in ('S','F'):
+                    self.ids.pop(key,None)
+                    newids.pop(key,None)
+            if len(done) > 0:
+                cur.executemany('UPDATE files SET tsstart=tsstart,tsend=%s,status=%s WHERE idfiles=%s AND tsstart=%s',done)
+            if len(failed) > 0:
+                cur.executemany('UPDATE files SET tsstart=tsstart,status=%s WHERE idfiles=%s AND tsstart=%s',failed)
+            self.myconn.commit()
+        except Exception:
             try:
-                e = self.conn.stat(self.joinpath(pathTo,sfile2))
-                b = (e.st_size == os.stat(os.path.join(pathFrom,sfile1)).st_size)
+                self.myconn.rollback()
             except Exception as e:
-                b = False
-            if not b:
-                self.logclass.logError('Upload failed',self.lineno())
-                self.logclass.logFileFail()
-                return False
-
-            # Log a success of upload
-            self.logclass.logFilePass()
-            return True
-        except Exception as e:
-            # Upload failed
-            self.logclass.logError('Caught exception: {c}: {e}'.format(c=e.__class__,e=e),self.lineno())
-            self.logclass.logFileFail()
-            return False
+                pass
+            raise
+        finally:
+            cur.close()
+        self.ids.update(newids)
+        self.__spill(orphans)
 
 ##############################################################################
 ## logoutput class
@@ -428,24 +3932,80 @@ class logoutput:
     logger = False
     sid = ''
     id = ''
-    myconn = False
+    logfile = ''
+    dbwriter = False
+    metrics = False
     maxBytes = 512000
     backupCount = 10
     debug = False
+    listener = False
+    events = False          # file sink wants file events (logFile* calls)
 
     # ---------------------------------------------------------------------------------------------------------
     # Init class
-    def __init__(self,sid='',logfile='',level=logging.DEBUG):
+    # The log file is written by a background listener, logging only queues the record. It's rotated at
+    # "maxBytes" or, when "when" is given, by time (see TimedRotatingFileHandler: midnight, h, d, w0..w6)
+    # keeping "backupCount" old files, which are gzipped in the background when "compress" is set.
+    def __init__(self,sid='',logfile='',level=logging.DEBUG,maxBytes=512000,backupCount=10,when='',compress=False):
         self.sid = sid
         self.id = 0
+        self.logfile = logfile
+        self.dbwriter = False
+        self.metrics = metrics()
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.events = False
+        self.files = {}             # id => (ffile,tfile,start,set) of file events
+        self.filesLock = threading.Lock()
+        self.local = threading.local()
+        self.lid = 0
+        self.rotators = []          # gzrotator of each compressed file, waited for on close
 
         self.logger = logging.getLogger(self.sid)
-        hdlr = logging.handlers.RotatingFileHandler(filename=logfile, mode='a', maxBytes=self.maxBytes, backupCount=self.backupCount)
-        formatter = logging.Formatter('%(asctime)s %(levelname)-8s %(message)s')
-        hdlr.setFormatter(formatter)
-        self.logger.addHandler(hdlr) 
+        hdlr = self.__fileHandler(logfile,maxBytes,backupCount,when,compress)
+        hdlr.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s'))
+        hdlr.addFilter(lambda record: not hasattr(record,'event'))
+        self.queue = queue.Queue()
+        self.qhandler = logging.handlers.QueueHandler(self.queue)
+        self.listener = logging.handlers.QueueListener(self.queue,hdlr,respect_handler_level=True)
+        self.listener.start()
+        self.logger.addHandler(self.qhandler)
         self.logger.setLevel(level)
 
+    # ---------------------------------------------------------------------------------------------------------
+    # Rotating file handler of "filename", see __init__
+    def __fileHandler(self,filename,maxBytes,backupCount,when,compress):
+        if when != '':
+            hdlr = logging.handlers.TimedRotatingFileHandler(filename=filename,when=when,backupCount=backupCount)
+        else:
+            hdlr = logging.handlers.RotatingFileHandler(filename=filename,mode='a',maxBytes=maxBytes,backupCount=backupCount)
+        if compress:
+            r = gzrotator()
+            r.attach(hdlr)
+            self.rotators.append(r)
+        return hdlr
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Add a json lines file "filename" (rotation as __init__): one json object per record with ts, level,
+    # sid, set and msg, and one per file event with file, target, bytes, duration and status
+    def openJson(self,filename,maxBytes=512000,backupCount=10,when='',compress=False):
+        hdlr = self.__fileHandler(filename,maxBytes,backupCount,when,compress)
+        hdlr.setFormatter(jsonformatter(self.sid))
+        self.listener.handlers = self.listener.handlers + (hdlr,)
+        self.events = True
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Set the set being run by the current thread, added to its records
+    def setSection(self,section=''):
+        self.local.section = section
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Use metrics "m" for timing of logging
+    def setMetrics(self,m):
+        self.metrics = m
+        if not self.dbwriter == False:
+            self.dbwriter.metrics = m
+
     # ---------------------------------------------------------------------------------------------------------
     # Set debug state. Setting to True will also print to console all log messages
     def setDebug(self,d=False):
@@ -453,39 +4013,53 @@ class logoutput:
 
     # ---------------------------------------------------------------------------------------------------------
     # Open connection to "transfers" database
+    # The database is written by a background writer, so logging never waits for the database.
+    # The writer connects when the first events are written, a run logging nothing to the database
+    # doesn't connect at all.
+    # If the database can't be reached the events are kept in "<logfile>.spill" until it can.
     def opendb(self,host='',user='',password='',port=3306,db='transfers'):
         if host != '':
-            try:
-                config = {
-                    'host': host,
-                    'port': port,
-                    'database': db,
-                    'user': user,
-                    'password': password,
-                    'charset': 'utf8',
-                    'use_unicode': True,
-                    'get_warnings': True
-                }
-                self.myconn = mysql.connector.Connect(**config)
-            except Exception as e:
-                self.logError('Caught exception: {c}: {e}'.format(c=e.__class__,e=e),self.lineno())
-                self.myconn == False
+            config = {
+                'host': host,
+                'port': port,
+                'database': db,
+                'user': user,
+                'password': password,
+                'charset': 'utf8',
+                'use_unicode': True,
+                'get_warnings': True
+            }
+            spillfile = self.logfile + '.spill' if self.logfile != '' else ''
+            self.dbwriter = dbwriter(self.sid,config,False,spillfile,self.logger)
+            self.dbwriter.metrics = self.metrics
 
     # ---------------------------------------------------------------------------------------------------------
     # Get current line in code when called
     def lineno(self):
-        return inspect.currentframe().f_back.f_lineno
+        return sys._getframe(1).f_lineno
 
     # ---------------------------------------------------------------------------------------------------------
-    # Close database
+    # Close database and log files, waits until all queued events are written and rotated files are
+    # compressed. The handlers are removed from the logger (shared by logoutputs of the same sid),
+    # nothing is logged after this.
     def close(self):
-        if not self.myconn == False:
-            self.myconn.close()
-            self.myconn = False
+        if not self.dbwriter == False:
+            self.dbwriter.close()
+            self.dbwriter = False
+        if not self.listener == False:
+            self.listener.stop()
+            self.logger.removeHandler(self.qhandler)
+            for hdlr in self.listener.handlers:
+                hdlr.close()
+            for r in self.rotators:
+                r.wait()
+            self.listener = False
+            self.logger = False
 
     # ---------------------------------------------------------------------------------------------------------
     # Log the message (file and/or database)
     def __logIt(self,msg,lineno=0,db=True,st=''):
+        t = self.metrics.start()
         if lineno > 0:
             # We have a line number, prepend it
             msg = '[{lineno}] {msg}'.format(lineno=lineno,msg=msg)
@@ -494,21 +4068,21 @@ class logoutput:
             print(msg)
         if not self.logger == False:
             # Log to file
+            extra = {'set': getattr(self.local,'section','')}
             if st == 'E':
-                self.logger.error(msg)
+                self.logger.error(msg,extra=extra)
             elif st == 'I':
-                self.logger.info(msg)
+                self.logger.info(msg,extra=extra)
             elif st == 'C':
-                self.logger.critical(msg)                
+                self.logger.critical(msg,extra=extra)
             elif st == 'D':
-                self.logger.debug(msg)
+                self.logger.debug(msg,extra=extra)
             elif st == 'W':
-                self.logger.warning(msg)
-        if (db) and (not self.myconn == False):
+                self.logger.warning(msg,extra=extra)
+        if (db) and (not self.dbwriter == False):
             # Log to database
-            mycursor = self.myconn.cursor()
-            mycursor.callproc('log',(st,self.sid,msg))
-            mycursor.close()
+            self.dbwriter.putLog(st,msg)
+        self.metrics.stop(t,'log')
 
     # ---------------------------------------------------------------------------------------------------------
     # Log a error message
@@ -538,46 +4112,197 @@ class logoutput:
     # ---------------------------------------------------------------------------------------------------------
     # Log a specific event into database only:
     # Mark a upload start of file "ffile" to location "tfile"
+    # Returns the id of the event (0 if not logged), which can be given to the other logFile* calls.
+    # This is needed when several files are uploaded at the same time.
     def logFileCreate(self,ffile,tfile):
-        if not self.myconn == False:
-            mycursor = self.myconn.cursor()
-            results = mycursor.callproc('logfileU',(self.sid,ffile,tfile,0))
-            mycursor.close()
-            try:
-                # Interested in id only
-                self.id = int(results[3])
-            except Exception as e:
-                self.logError('Caught exception: {c}: {e}'.format(c=e.__class__,e=e),self.lineno())
-                self.id = 0
-            return True
+        if not self.dbwriter == False:
+            id = self.dbwriter.newId()
+            self.dbwriter.putFile('U',id,ffile,tfile)
+        elif self.events:
+            with self.filesLock:
+                self.lid += 1
+                id = self.lid
         else:
-            return False
+            return 0
+        if self.events:
+            with self.filesLock:
+                self.files[id] = (ffile,tfile,time.perf_counter(),getattr(self.local,'section',''))
+        self.id = id
+        return id
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Queue a file event for event "id" (or the latest created event if id not given, an id of 0 is
+    # an event not logged and ignored)
+    def __logFileEvent(self,ev,id=None):
+        if id is None:
+            id = self.id
+        if (id > 0) and (self.dbwriter != False):
+            self.dbwriter.putFile(ev,id)
+        return id
+
+    # ---------------------------------------------------------------------------------------------------------
+    # End of file event "id" with "status" (pass or fail) and "size" bytes (-1 unknown) into the json sink
+    def __logFileDone(self,status,id,size):
+        if id is None:
+            id = self.id
+        with self.filesLock:
+            f = self.files.pop(id,None)
+        if (f is None) or (self.logger == False):
+            return
+        self.logger.info('{s} {f}'.format(s=status,f=f[0]),extra={'event': {
+            'file': f[0], 'target': f[1], 'bytes': size if size >= 0 else None,
+            'duration': round(time.perf_counter() - f[2],6), 'status': status}, 'set': f[3]})
 
     # ---------------------------------------------------------------------------------------------------------
     # Log a specific event into database only:
     # Mark a "checking" event created against previous filelog created with "logFileCreate"
-    def logFileCheck(self):
-        if (self.id > 0) and (self.myconn != False):
-            mycursor = self.myconn.cursor()
-            mycursor.callproc('logfileC',(self.id,))
-            mycursor.close()
+    def logFileCheck(self,id=None):
+        self.__logFileEvent('C',id)
 
     # ---------------------------------------------------------------------------------------------------------
     # Log a specific event into database only:
-    # Mark a "pass" of event created against previous filelog created with "logFileCreate"
-    def logFilePass(self):
-        if (self.id > 0) and (self.myconn != False):
-            mycursor = self.myconn.cursor()
-            mycursor.callproc('logfileS',(self.id,))
-            mycursor.close()
+    # Mark a "pass" of event created against previous filelog created with "logFileCreate",
+    # "size" is the number of bytes transfered when known
+    def logFilePass(self,id=None,size=-1):
+        if self.events:
+            self.__logFileDone('pass',id,size)
+        if self.__logFileEvent('S',id) == self.id:
             self.id = 0
 
     # ---------------------------------------------------------------------------------------------------------
     # Log a specific event into database only:
     # Mark a "fail" of event created against previous filelog created with "logFileCreate"
-    def logFileFail(self):
-        if (self.id > 0) and (self.myconn != False):
-            mycursor = self.myconn.cursor()
-            mycursor.callproc('logfileF',(self.id,))
-            mycursor.close()
+    def logFileFail(self,id=None):
+        if self.events:
+            self.__logFileDone('fail',id,-1)
+        if self.__logFileEvent('F',id) == self.id:
             self.id = 0
+
+##############################################################################
+## jsonformatter class
+## Formats a log record as one json object (json lines): ts, level, sid, set
+## and msg, and the fields of a file event (file, target, bytes, duration,
+## status). Runs in the listener thread of logoutput, not in the caller.
+##############################################################################
+class jsonformatter(logging.Formatter):
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class
+    def __init__(self,sid=''):
+        logging.Formatter.__init__(self)
+        self.sid = sid
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Format "record"
+    def format(self,record):
+        out = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'sid': self.sid,
+            'set': getattr(record,'set','')
+        }
+        event = getattr(record,'event',None)
+        if event is not None:
+            out.update(event)
+        else:
+            out['msg'] = record.getMessage()
+        return json.dumps(out)
+
+##############################################################################
+## gzrotator class
+## Rotator and namer of a rotating file handler gzipping the rotated files in
+## a background thread. A rollover of the handler first waits for the
+## compression of the previous one, so the old files are renamed (shifted)
+## only when complete.
+##############################################################################
+class gzrotator:
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Init class
+    def __init__(self):
+        self.thread = False
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Use for rotating file handler "hdlr"
+    def attach(self,hdlr):
+        hdlr.namer = self.namer
+        hdlr.rotator = self.rotate
+        rollover = hdlr.doRollover
+        def doRollover():
+            self.wait()
+            rollover()
+        hdlr.doRollover = doRollover
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Wait for the running compression
+    def wait(self):
+        if not self.thread == False:
+            self.thread.join()
+            self.thread = False
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Name of rotated file "name"
+    def namer(self,name):
+        return name + '.gz'
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Rotate file "source" to "dest" (a name from namer)
+    def rotate(self,source,dest):
+        self.wait()
+        tmpfile = dest[:-3] if dest.endswith('.gz') else dest + '.rotated'
+        os.replace(source,tmpfile)
+        self.thread = threading.Thread(target=self.__compress,args=(tmpfile,dest),name='gzrotator',daemon=True)
+        self.thread.start()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Compress "tmpfile" into "dest" and remove it
+    def __compress(self,tmpfile,dest):
+        import gzip
+        try:
+            with open(tmpfile,'rb') as f:
+                with gzip.open(dest + '.tmp','wb') as g:
+                    shutil.copyfileobj(f,g)
+            os.replace(dest + '.tmp',dest)
+            os.remove(tmpfile)
+        except OSError:
+            # Keep the uncompressed file
+            pass
+
+##############################################################################
+## log sink registry
+## Log sinks of logoutput by name. "opener(log,s)" adds the sink to logoutput
+## "log" using settings "s"; customer opens each sink having a section of the
+## same name in its .ini file.
+##############################################################################
+logsinks = {}
+
+# ---------------------------------------------------------------------------------------------------------
+# Register log sink "name"
+def registerLogSink(name,opener):
+    logsinks[name] = opener
+
+# ---------------------------------------------------------------------------------------------------------
+# "transfers" database, section [mysql]
+def openMysql(log,s):
+    log.opendb(
+        host=s.getString('mysql','host',''),
+        user=s.getString('mysql','user',''),
+        password=s.getString('mysql','pswd',''),
+        port=s.getInt('mysql','port',3306)
+    )
+
+registerLogSink('mysql',openMysql)
+
+# ---------------------------------------------------------------------------------------------------------
+# Json lines file, section [jsonlog], next to the log file unless "file" is a full path
+def openJsonLog(log,s):
+    filename = s.getString('jsonlog','file',os.path.splitext(log.logfile)[0] + '.jsonl')
+    log.openJson(
+        os.path.join(os.path.dirname(log.logfile),filename),
+        maxBytes=s.getInt('jsonlog','maxsize',s.getInt('log','maxsize',500)) * 1024,
+        backupCount=s.getInt('jsonlog','backups',s.getInt('log','backups',10)),
+        when=s.getString('jsonlog','rotate',s.getString('log','rotate','')),
+        compress=s.getInt('jsonlog','compress',s.getInt('log','compress',0)) == 1
+    )
+
+registerLogSink('jsonlog',openJsonLog)